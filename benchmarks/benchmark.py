@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+import argparse
+import builtins
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+"""
+Benchmark the replace-with-symlinks and replace-with-content flows end to end, on generated trees.
+The symlink target directory can be made to behave like a slow remote (FUSE) mount, by adding latency
+to each stat, directory listing, open and read done on it.
+The results are written as JSON, and can be compared with the results of another version:
+    python3 benchmarks/benchmark.py --output before.json
+    (change things)
+    python3 benchmarks/benchmark.py --output after.json --compare before.json
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import symlinkerr  # noqa: E402
+
+logger = logging.getLogger("benchmark")
+
+
+def parse_sizes(sizes: str) -> list[tuple[int, int]]:
+    # "1M:60,8M:30,32M:10" => [(size in bytes, weight)]
+    units = {"K": 2**10, "M": 2**20, "G": 2**30}
+    parsed = []
+    for item in sizes.split(","):
+        size, weight = item.split(":")
+        size = size.strip().upper()
+        if size[-1] in units:
+            parsed.append((int(float(size[:-1]) * units[size[-1]]), int(weight)))
+        else:
+            parsed.append((int(size), int(weight)))
+    return parsed
+
+
+class SyntheticTrees:
+    # Watch and target trees, with some of the watched files duplicated in the target tree,
+    # and some target files having the name of a watched file with a different content
+
+    block_size: int = 2**16
+
+    def __init__(self, args: argparse.Namespace, workdir: str):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.watch = os.path.join(workdir, "watch")
+        self.target = os.path.join(workdir, "target")
+        self.undo = os.path.join(workdir, "undo")
+        self.sizes = parse_sizes(args.sizes)
+
+        self.watch_files: list[str] = []
+        self.duplicates: list[str] = []  # In the target tree
+        self.total_bytes = 0
+
+    def get_directory(self, root: str, index: int) -> str:
+        # Nested directories, with files-per-directory files in each
+        directory = index // self.args.files_per_directory
+        return os.path.join(root, f"d{directory % 10}", f"d{directory}")
+
+    def write_file(self, fullpath: str, size: int) -> None:
+        # Repeating a random block keeps this fast, while the content (and the samples) differ between files
+        block = self.random.randbytes(self.block_size)
+        os.makedirs(os.path.dirname(fullpath), exist_ok=True)
+        with open(fullpath, "wb") as f:
+            written = 0
+            while written < size:
+                f.write(block[: min(self.block_size, size - written)])
+                written += self.block_size
+
+    def generate(self) -> None:
+        sizes, weights = zip(*self.sizes)
+        old = time.time() - 86400
+
+        for i in range(self.args.files):
+            # Real files rarely have the exact same size
+            size = self.random.choices(sizes, weights)[0] + self.random.randrange(2**16)
+            filename = f"file{i}.mkv"
+            fullpath = os.path.join(self.get_directory(self.watch, i), filename)
+            self.write_file(fullpath, size)
+            os.utime(fullpath, (old, old))
+            self.watch_files.append(fullpath)
+            self.total_bytes += size
+
+            if self.random.random() < self.args.duplicate_ratio:
+                duplicate = os.path.join(
+                    self.get_directory(self.target, i), f"renamed{i}.mkv"
+                )
+                os.makedirs(os.path.dirname(duplicate), exist_ok=True)
+                shutil.copyfile(fullpath, duplicate)
+                self.duplicates.append(duplicate)
+            elif self.random.random() < self.args.filename_collision_ratio:
+                # Same name and size, different content: only the hashes can tell
+                self.write_file(
+                    os.path.join(self.get_directory(self.target, i), filename), size
+                )
+
+        for i in range(self.args.target_only_files):
+            self.write_file(
+                os.path.join(
+                    self.get_directory(self.target, self.args.files + i),
+                    f"other{i}.mkv",
+                ),
+                self.random.choices(sizes, weights)[0] + self.random.randrange(2**16),
+            )
+
+        os.makedirs(self.target, exist_ok=True)
+        os.makedirs(self.undo, exist_ok=True)
+
+    def make_undo_symlinks(self) -> list[str]:
+        # Symlinks to the duplicates, to be replaced with their content
+        symlinks = []
+        for i, duplicate in enumerate(self.duplicates[: self.args.undo_files]):
+            symlink = os.path.join(self.undo, f"restored{i}.mkv")
+            os.symlink(duplicate, symlink)
+            symlinks.append(symlink)
+        return symlinks
+
+
+class SlowMount:
+    # Counts the filesystem calls, and adds latency to the ones done on the slow directory, like a remote mount would
+    # Only the Python level calls can be intercepted: the counts are an approximation of the syscalls
+
+    def __init__(self, directory: str, stat_latency: float, read_latency: float):
+        self.directory = directory.rstrip(os.sep) + os.sep
+        self.stat_latency = stat_latency
+        self.read_latency = read_latency
+        self.counts: dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()  # Our own calls (resolving symlinks) are not counted
+        self.originals = {}
+        self.slow_fds: set[int] = set()  # Files opened on the slow directory, for the calls taking a fd
+
+    def count(self, name: str, path=None, latency: float = 0, amount: int = 1) -> None:
+        if getattr(self.local, "resolving", False):
+            return
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+        if latency > 0 and (path is None or self.is_slow(path)):
+            time.sleep(latency)
+
+    def is_slow(self, path, resolve: bool = False) -> bool:
+        if isinstance(path, int):
+            return False
+        path = os.fsdecode(path)
+        if path.startswith(self.directory):
+            return True
+        if not resolve:
+            return False
+
+        # Symlinks to the slow directory are slow too
+        self.local.resolving = True
+        try:
+            return os.path.realpath(path).startswith(self.directory)
+        finally:
+            self.local.resolving = False
+
+    def reset(self) -> dict[str, int]:
+        with self.lock:
+            counts = self.counts
+            self.counts = {}
+        return counts
+
+    def install(self) -> None:
+        mount = self
+        self.originals = {
+            "stat": os.stat,
+            "lstat": os.lstat,
+            "scandir": os.scandir,
+            "open": builtins.open,
+            "pread": os.pread,
+            "copy_file_range": getattr(os, "copy_file_range", None),
+            "sendfile": getattr(os, "sendfile", None),
+        }
+        original = self.originals
+
+        class SlowDirEntry:
+            def __init__(self, entry: os.DirEntry):
+                self.entry = entry
+                self.name = entry.name
+                self.path = entry.path
+
+            def stat(self, follow_symlinks: bool = True):
+                mount.count("stat", self.path, mount.stat_latency)
+                return self.entry.stat(follow_symlinks=follow_symlinks)
+
+            def __getattr__(self, name):
+                return getattr(self.entry, name)
+
+        class SlowScandir:
+            def __init__(self, path):
+                self.iterator = original["scandir"](path)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                self.iterator.close()
+
+            def __iter__(self):
+                for entry in self.iterator:
+                    yield SlowDirEntry(entry)
+
+        class SlowFile:
+            def __init__(self, f, slow: bool):
+                self.f = f
+                self.slow = slow
+
+            def read(self, *args):
+                mount.count("read", None, mount.read_latency if self.slow else 0)
+                data = self.f.read(*args)
+                mount.count("read_bytes", amount=len(data))
+                return data
+
+            def readinto(self, buffer):
+                mount.count("read", None, mount.read_latency if self.slow else 0)
+                read = self.f.readinto(buffer)
+                mount.count("read_bytes", amount=read or 0)
+                return read
+
+            def close(self):
+                mount.slow_fds.discard(self.f.fileno())
+                return self.f.close()
+
+            def __enter__(self):
+                self.f.__enter__()
+                return self
+
+            def __exit__(self, *args):
+                if not self.f.closed:
+                    mount.slow_fds.discard(self.f.fileno())
+                return self.f.__exit__(*args)
+
+            def __getattr__(self, name):
+                return getattr(self.f, name)
+
+        def stat(path, *args, **kwargs):
+            mount.count("stat", path, mount.stat_latency)
+            return original["stat"](path, *args, **kwargs)
+
+        def lstat(path, *args, **kwargs):
+            mount.count("lstat", path, mount.stat_latency)
+            return original["lstat"](path, *args, **kwargs)
+
+        def scandir(path="."):
+            mount.count("scandir", path, mount.stat_latency)
+            return SlowScandir(path)
+
+        def open_file(file, mode="r", *args, **kwargs):
+            f = original["open"](file, mode, *args, **kwargs)
+            if "b" not in mode or "r" not in mode:
+                return f
+            slow = mount.is_slow(file, resolve=True)
+            mount.count("open", None, mount.stat_latency if slow else 0)
+            if slow:
+                mount.slow_fds.add(f.fileno())
+            return SlowFile(f, slow)
+
+        def pread(fd, length, offset):
+            # Used to read a single file from several threads (hash trees)
+            mount.count("read", None, mount.read_latency if fd in mount.slow_fds else 0)
+            data = original["pread"](fd, length, offset)
+            mount.count("read_bytes", amount=len(data))
+            return data
+
+        def copy_file_range(*args, **kwargs):
+            mount.count("copy_file_range", None, mount.read_latency)
+            return original["copy_file_range"](*args, **kwargs)
+
+        def sendfile(*args, **kwargs):
+            mount.count("sendfile", None, mount.read_latency)
+            return original["sendfile"](*args, **kwargs)
+
+        os.stat = stat
+        os.lstat = lstat
+        os.scandir = scandir
+        builtins.open = open_file
+        os.pread = pread
+        if original["copy_file_range"] is not None:
+            os.copy_file_range = copy_file_range
+        if original["sendfile"] is not None:
+            os.sendfile = sendfile
+
+    def uninstall(self) -> None:
+        os.stat = self.originals["stat"]
+        os.lstat = self.originals["lstat"]
+        os.scandir = self.originals["scandir"]
+        builtins.open = self.originals["open"]
+        os.pread = self.originals["pread"]
+        if self.originals["copy_file_range"] is not None:
+            os.copy_file_range = self.originals["copy_file_range"]
+        if self.originals["sendfile"] is not None:
+            os.sendfile = self.originals["sendfile"]
+
+
+def write_config(args: argparse.Namespace, trees: SyntheticTrees, workdir: str) -> str:
+    config = {
+        "database": os.path.join(workdir, "symlinkerr.sqlite"),
+        "logger": {"level": args.log_level},
+        "metrics": {"json-file": os.path.join(workdir, "metrics.json")},
+        "finder": {
+            "find-candidates-by": args.find_candidates_by,
+            "directories": {
+                "watch-directories": [{"dir": trees.watch}],
+                "symlink-target-directories": [{"dir": trees.target, "priority": 1}],
+                "undo-all-symlinks-directories": [{"dir": trees.undo}],
+            },
+        },
+        "checker": {"files-min-size-bytes": 1, "files-min-age-seconds": 0},
+        "replacer": {
+            "dry-run": False,
+            "chown-uid": os.getuid(),
+            "chown-gid": os.getgid(),
+        },
+    }
+
+    config_file = os.path.join(workdir, "config.yml")
+    with open(config_file, "w") as f:
+        json.dump(config, f)  # JSON is valid YAML
+    return config_file
+
+
+def run_action(
+    action: str, config_file: str, workdir: str, mount: SlowMount
+) -> dict:
+    sys.argv = ["symlinkerr.py", "-c", config_file, action]
+    metrics_file = os.path.join(workdir, "metrics.json")
+    if os.path.exists(metrics_file):
+        os.remove(metrics_file)
+    mount.reset()
+    start_time = time.perf_counter()
+    symlinkerr.main()
+    duration = time.perf_counter() - start_time
+
+    # Versions without metrics only get the wall time and the intercepted calls
+    metrics = {}
+    if os.path.exists(metrics_file):
+        with open(metrics_file) as f:
+            metrics = json.load(f)
+    return {"seconds": duration, "calls": mount.reset(), "metrics": metrics}
+
+
+def get_version() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: dict, previous_file: str) -> None:
+    with open(previous_file) as f:
+        previous = json.load(f)
+
+    print(f"{'':<24}{previous['version']:>16}{results['version']:>16}{'':>10}")
+    for flow, result in results["flows"].items():
+        if flow not in previous["flows"]:
+            continue
+        for key in ["seconds", "files_per_second", "mb_per_second"]:
+            before = previous["flows"][flow][key]
+            after = result[key]
+            ratio = f"x{after / before:.2f}" if before else ""
+            print(f"{flow + ' ' + key:<40}{before:>16.2f}{after:>16.2f}{ratio:>10}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the replace-with-symlinks and replace-with-content flows on generated trees"
+    )
+    parser.add_argument("--files", type=int, default=200, help="Files in the watch tree")
+    parser.add_argument(
+        "--sizes",
+        default="1M:60,4M:30,16M:10",
+        help="Size distribution of the files, as size:weight (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--duplicate-ratio",
+        type=float,
+        default=0.5,
+        help="Part of the watched files having a copy in the target tree (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--filename-collision-ratio",
+        type=float,
+        default=0.2,
+        help="Part of the other watched files having a different file with the same name and size in the target tree (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--target-only-files",
+        type=int,
+        default=500,
+        help="Unrelated files in the target tree (default: %(default)s)",
+    )
+    parser.add_argument("--files-per-directory", type=int, default=20)
+    parser.add_argument(
+        "--undo-files",
+        type=int,
+        default=20,
+        help="Symlinks to replace with their content (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--stat-latency-ms",
+        type=float,
+        default=0,
+        help="Latency added to each stat, listing and open in the target tree (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--read-latency-ms",
+        type=float,
+        default=0,
+        help="Latency added to each read from the target tree (default: %(default)s)",
+    )
+    parser.add_argument("--find-candidates-by", default="SIZE")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workdir", help="Where to generate the trees (default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated trees")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", default="benchmark.json", help="Results file (default: %(default)s)")
+    parser.add_argument("--compare", help="Results file of a previous run to compare with")
+    args = parser.parse_args()
+    args.output = os.path.abspath(args.output)
+    if args.compare:
+        args.compare = os.path.abspath(args.compare)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s - %(module)s - %(message)s",
+    )
+    # symlinkerr sets the level of the root logger to --log-level, our results are still logged
+    logger.setLevel(logging.INFO)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="symlinkerr-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    trees = SyntheticTrees(args, workdir)
+    mount = SlowMount(
+        trees.target, args.stat_latency_ms / 1000, args.read_latency_ms / 1000
+    )
+
+    try:
+        logger.info(f"Generating {args.files} files in {workdir}")
+        trees.generate()
+        config_file = write_config(args, trees, workdir)
+
+        # symlinkerr.py expects to be run from its directory
+        os.chdir(ROOT)
+        mount.install()
+        flows = {}
+        try:
+            result = run_action("replace-with-symlinks", config_file, workdir, mount)
+            result["files"] = len(trees.watch_files)
+            result["bytes"] = trees.total_bytes
+            flows["replace-with-symlinks"] = result
+
+            symlinks = trees.make_undo_symlinks()
+            result = run_action("replace-with-content", config_file, workdir, mount)
+            result["files"] = len(symlinks)
+            result["bytes"] = sum(os.path.getsize(s) for s in symlinks)
+            flows["replace-with-content"] = result
+        finally:
+            mount.uninstall()
+
+        for flow, result in flows.items():
+            result["files_per_second"] = result["files"] / result["seconds"]
+            result["mb_per_second"] = result["bytes"] / 10**6 / result["seconds"]
+            logger.info(
+                f"{flow}: {result['files']} files in {result['seconds']:.2f} seconds, "
+                + f"{result['files_per_second']:.1f} files/s, {result['mb_per_second']:.1f} MB/s, calls: {result['calls']}"
+            )
+
+        results = {
+            "version": get_version(),
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "parameters": vars(args),
+            "duplicates": len(trees.duplicates),
+            "flows": flows,
+        }
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Results written to {args.output}")
+
+        if args.compare:
+            compare(results, args.compare)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
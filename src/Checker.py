@@ -1,10 +1,19 @@
-import hashlib
 import logging
-import re
+import random
 import sqlite3
+import threading
 import time
+from typing import Callable
 
+from src.ChecksumSources import ChecksumSources
+from src.Exclusions import Exclusions
 from src.File import File
+from src.HashAlgorithms import HashAlgorithms
+from src.HashExecutor import HashExecutor
+from src.HashTree import HashTree
+from src.IoScheduler import IoLimiter, IoScheduler
+from src.Metrics import Metrics
+from src.Profiler import Profiler
 
 """
 Perform the replacement checks
@@ -14,49 +23,150 @@ Perform the replacement checks
 class Checker:
     logger = logging.getLogger("Checker")
 
-    def __init__(self, config: dict, database: sqlite3.Connection):
+    def __init__(
+        self,
+        config: dict,
+        database: sqlite3.Connection,
+        io_scheduler: IoScheduler = None,
+        metrics: Metrics = None,
+        profiler: Profiler = None,
+    ):
         self.config = config
         self.database = database
+        self.io_scheduler = io_scheduler
+        self.metrics = metrics or Metrics()
+        self.profiler = profiler or Profiler()
 
         self.min_size = self.config["files-min-size-bytes"]
         self.min_age = self.config["files-min-age-seconds"]
         self.check_hash = config["check-hash"]
+        self.hash_algorithm = config["hash-algorithm"]
+        HashAlgorithms.check(self.hash_algorithm)
+        self.check_fingerprint = config["check-fingerprint"]
+        self.fingerprint_sample_size = config["fingerprint-sample-bytes"]
         self.change_in_mtime_invalidates_hash = config[
             "change-in-mtime-invalidates-hash"
         ]
+        self.inode_cache = config["inode-cache"]
 
-        self.exclude_watch_directories = [
-            re.compile(r) for r in config["exclusions"]["watch-directories-regexes"]
-        ]
-        self.exclude_target_directories = [
-            re.compile(r)
-            for r in config["exclusions"]["symlink-target-directories-regexes"]
-        ]
-        self.exclude_undo_symlinks_directories = [
-            re.compile(r)
-            for r in config["exclusions"]["undo-all-symlinks-directories-regexes"]
-        ]
+        # Also used by the walkers to prune the excluded directories
+        self.exclude_watch_directories = Exclusions(
+            config["exclusions"]["watch-directories-regexes"]
+        )
+        self.exclude_target_directories = Exclusions(
+            config["exclusions"]["symlink-target-directories-regexes"]
+        )
+        self.exclude_undo_symlinks_directories = Exclusions(
+            config["exclusions"]["undo-all-symlinks-directories-regexes"]
+        )
+
+        # Checksums already known, so the files don't have to be read
+        self.checksum_sources = ChecksumSources(
+            config["checksum-sources"], self.hash_algorithm
+        )
+        self.hash_sources: dict[str, str] = {}  # Fullpath => where its hash came from, until stored
+        self.lock = threading.Lock()
+
+        # Large files are hashed as chunks read concurrently, see HashTree
+        self.hash_tree_enabled = config["hash-tree"]["enabled"]
+        self.hash_tree_min_size = config["hash-tree"]["min-size-bytes"]
+        self.hash_tree = HashTree(
+            self.hash_algorithm,
+            config["hash-tree"]["chunk-bytes"],
+            config["hash-tree"]["threads-per-file"],
+        )
+        self.hash_chunks: dict[str, list[str]] = {}  # Fullpath => chunks of its hash, until stored
+
+        self.hash_executor = HashExecutor(config["hashing"])
+        self.hashing_batch_size = config["hashing"]["batch-size"]
 
         self.create_hashes_table()
 
     def clear_hashes_cache(self) -> None:
         self.database.execute("DROP TABLE IF EXISTS hashes;")
+        self.database.execute("DROP TABLE IF EXISTS hash_chunks;")
         self.create_hashes_table()  # This will do the commit()
 
     def create_hashes_table(self) -> None:
         self.database.execute("""
             CREATE TABLE IF NOT EXISTS hashes (
-                fullpath VARCHAR PRIMARY KEY,
+                fullpath VARCHAR,
+                algorithm VARCHAR,
                 hash VARCHAR,
                 size LONG,
-                mtime LONG
+                mtime LONG,
+                fingerprint VARCHAR,
+                PRIMARY KEY (fullpath, algorithm)
+            );
+        """)
+
+        # Caches created by older versions only have md5 hashes, keyed by fullpath
+        columns = [
+            c[1] for c in self.database.execute("PRAGMA table_info(hashes);").fetchall()
+        ]
+        if "algorithm" not in columns:
+            self.logger.info("Migrating the hashes cache to support multiple algorithms")
+            fingerprint = "fingerprint" if "fingerprint" in columns else "NULL"
+            self.database.execute("ALTER TABLE hashes RENAME TO hashes_old;")
+            self.database.execute("""
+                CREATE TABLE hashes (
+                    fullpath VARCHAR,
+                    algorithm VARCHAR,
+                    hash VARCHAR,
+                    size LONG,
+                    mtime LONG,
+                    fingerprint VARCHAR,
+                    PRIMARY KEY (fullpath, algorithm)
+                );
+            """)
+            self.database.execute(f"""
+                INSERT INTO hashes(fullpath, algorithm, hash, size, mtime, fingerprint)
+                SELECT fullpath, 'md5', hash, size, mtime, {fingerprint} FROM hashes_old
+            """)
+            self.database.execute("DROP TABLE hashes_old;")
+
+        # The same content can be found again after a rename, or through a hardlink
+        columns = [
+            c[1] for c in self.database.execute("PRAGMA table_info(hashes);").fetchall()
+        ]
+        if "inode" not in columns:
+            self.database.execute("ALTER TABLE hashes ADD COLUMN device LONG;")
+            self.database.execute("ALTER TABLE hashes ADD COLUMN inode LONG;")
+        self.database.execute("""
+            CREATE INDEX IF NOT EXISTS hashes__inode
+            ON hashes(device, inode, size, mtime)
+        """)
+
+        # Where the hash comes from: computed, imported, or provided by an xattr or a sidecar file
+        if "source" not in columns:
+            self.database.execute("ALTER TABLE hashes ADD COLUMN source VARCHAR;")
+
+        # Finding the files with a given hash, see find-candidates-by HASH
+        self.database.execute("""
+            CREATE INDEX IF NOT EXISTS hashes__hash
+            ON hashes(hash, algorithm)
+        """)
+
+        # The chunks of the hashes computed with the hash tree, the row in hashes has their root
+        self.database.execute("""
+            CREATE TABLE IF NOT EXISTS hash_chunks (
+                fullpath VARCHAR,
+                algorithm VARCHAR,
+                chunk INT,
+                hash VARCHAR,
+                PRIMARY KEY (fullpath, algorithm, chunk)
             );
         """)
+
         self.database.commit()
 
     def is_eligible_for_replacement(self, file: File) -> bool:
         # Do the fastest checks first
 
+        # Check that the file is not excluded, this doesn't need a stat
+        if self.exclude_watch_directories.is_file_excluded(file.fullpath):
+            return False
+
         # Check if the size matches the criteria
         if file.get_size() < self.min_size:
             self.logger.debug(
@@ -72,70 +182,422 @@ class Checker:
             )
             return False
 
-        # Check that the file is not excluded
-        for exclusion in self.exclude_watch_directories:
-            if exclusion.match(file.fullpath):
-                self.logger.debug(
-                    f"Ignoring file {file.fullpath}, matching exclusion regex '{exclusion.pattern}'"
-                )
-                return False
-
         return True
 
-    def can_be_replaced_with(self, original_file: File, replacement_file: File) -> bool:
-        # Check that the destination is not excluded
-        for exclusion in self.exclude_target_directories:
-            if exclusion.match(replacement_file.fullpath):
-                self.logger.debug(
-                    f"Replacement file {replacement_file.fullpath} matching exclusion regex '{exclusion.pattern}'"
-                )
-                return False
+    def is_excluded_target(self, replacement_file: File) -> bool:
+        return self.exclude_target_directories.is_file_excluded(
+            replacement_file.fullpath
+        )
 
-        # Check the file hashes
-        if self.check_hash:
-            original_file_hash = self.get_hash(original_file)
-            self.logger.debug(f"Hash {original_file_hash} for {original_file.fullpath}")
+    def can_be_replaced_with(
+        self, original_file: File, replacement_file: File, source=None
+    ) -> bool:
+        # The fingerprints and hashes come from the source, which is the cache by default
+        # (anything with get_fingerprints() and get_hashes() methods)
+        source = source or self
 
-            replacement_file_hash = self.get_hash(replacement_file)
-            self.logger.debug(
-                f"Hash {replacement_file_hash} for {replacement_file.fullpath}"
+        # Check that the destination is not excluded
+        if self.is_excluded_target(replacement_file):
+            return False
+
+        if not self.check_hash:
+            self.logger.info(
+                f"Not checking hashes, accepting {replacement_file.fullpath} as a candidate for {original_file.fullpath}"
             )
+            return True
+
+        # Compare a few samples of both files first, so we don't read the whole candidate when it's obviously different
+        # Both sides are read concurrently, as they are usually on different devices
+        if self.check_fingerprint:
+            fingerprints = source.get_fingerprints([original_file, replacement_file])
+            original_file_fingerprint = fingerprints[original_file.fullpath]
+            replacement_file_fingerprint = fingerprints[replacement_file.fullpath]
 
-            if original_file_hash != replacement_file_hash:
+            if original_file_fingerprint != replacement_file_fingerprint:
                 self.logger.info(
-                    f"Both files have different hashes, discarding {replacement_file.fullpath} as a candidate for {original_file.fullpath}"
+                    f"Both files have different fingerprints, discarding {replacement_file.fullpath} as a candidate for {original_file.fullpath}"
                 )
                 return False
 
+        # Check the file hashes
+        hashes = source.get_hashes([original_file, replacement_file])
+        original_file_hash = hashes[original_file.fullpath]
+        replacement_file_hash = hashes[replacement_file.fullpath]
+
+        if original_file_hash != replacement_file_hash:
+            self.logger.info(
+                f"Both files have different hashes, discarding {replacement_file.fullpath} as a candidate for {original_file.fullpath}"
+            )
+            return False
+
         self.logger.info(
             f"Both files have same hash {original_file_hash}, accepting {replacement_file.fullpath} as a candidate for {original_file.fullpath}"
         )
         return True
 
+    def order_candidates(
+        self,
+        original_file: File,
+        candidates: list[File],
+        cached_hashes: dict[str, str],
+        source=None,
+    ) -> list[File]:
+        # The candidates whose cached hash is the one of the original come first, then the ones that must be read,
+        # and the ones known to be different last (they are discarded without reading them)
+        # The original is only hashed if some of the candidates hashes are known, it would be anyway to check them
+        if not self.check_hash or not any(
+            candidate.fullpath in cached_hashes for candidate in candidates
+        ):
+            return candidates
+
+        try:
+            original_hash = (source or self).get_hashes([original_file])[
+                original_file.fullpath
+            ]
+        except Exception as e:
+            # Will be raised again, and properly reported, when checking that file
+            self.logger.debug(f"Could not hash {original_file.fullpath} to sort its candidates: {e}")
+            return candidates
+
+        matching = []
+        unknown = []
+        different = []
+        for candidate in candidates:
+            candidate_hash = cached_hashes.get(candidate.fullpath)
+            if candidate_hash is None:
+                unknown.append(candidate)
+            elif candidate_hash == original_hash:
+                matching.append(candidate)
+            else:
+                different.append(candidate)
+        return matching + unknown + different
+
+    def get_cached_hashes(self, files: list[File]) -> dict[str, str]:
+        # Only the ones in the cache, nothing is computed
+        hashes = {}
+        for file in files:
+            try:
+                value = self.get_cached(file, "hash")
+            except OSError:
+                continue  # Will be raised again, and properly reported, when checking that file
+            if value is not None:
+                hashes[file.fullpath] = value
+        return hashes
+
     def is_eligible_for_content_replacement(self, symlink_file: File) -> bool:
-        for exclusion in self.exclude_undo_symlinks_directories:
-            if exclusion.match(symlink_file.fullpath):
+        return not self.exclude_undo_symlinks_directories.is_file_excluded(
+            symlink_file.fullpath
+        )
+
+    def get_algorithm(self, file: File) -> str:
+        # What the hash of that file is cached as
+        if self.hash_tree_enabled and file.get_size() >= self.hash_tree_min_size:
+            return self.hash_tree.algorithm
+        return self.hash_algorithm
+
+    def get_cached(self, file: File, column: str) -> str | None:
+        # Fingerprints taken with another sample size can't be compared, they are computed again
+        comparable = f"{column} IS NOT NULL"
+        comparable_parameters = []
+        if column == "fingerprint":
+            comparable += " AND fingerprint LIKE ?"
+            comparable_parameters.append(f"{self.fingerprint_sample_size}:%")
+
+        query = f"SELECT {column} FROM hashes WHERE fullpath=? AND algorithm=? AND size=? AND {comparable}"
+        parameters = [file.fullpath, self.get_algorithm(file), file.get_size()]
+        parameters += comparable_parameters
+        if self.change_in_mtime_invalidates_hash:
+            query += " AND mtime=?"
+            parameters.append(file.get_mtime())
+
+        row = self.database.execute(query, parameters).fetchone()
+        if row is not None:
+            self.metrics.increment("hash_cache_lookups_total", column=column, result="hit")
+            return row[0]
+
+        if self.inode_cache:
+            # The file might have been renamed, or be a hardlink of a file we already know
+            # Size and mtime must always match here, as inode numbers get reused
+            row = self.database.execute(
+                f"SELECT {column}, fullpath, source FROM hashes WHERE device=? AND inode=? AND size=? AND mtime=? AND algorithm=? AND {comparable}",
+                [
+                    file.get_device(),
+                    file.get_inode(),
+                    file.get_size(),
+                    file.get_mtime(),
+                    self.get_algorithm(file),
+                ]
+                + comparable_parameters,
+            ).fetchone()
+            if row is not None:
                 self.logger.debug(
-                    f"Symlink {symlink_file} matching exclusion regex '{exclusion.pattern}'"
+                    f"Found the {column} of {file.fullpath} in the cache from {row[1]}, which has the same device and inode"
                 )
-                return False
+                self.store_in_cache(file, column, row[0], row[2])
+                self.metrics.increment(
+                    "hash_cache_lookups_total", column=column, result="inode_hit"
+                )
+                return row[0]
+
+        self.metrics.increment("hash_cache_lookups_total", column=column, result="miss")
+        return None
+
+    def store_in_cache(
+        self,
+        file: File,
+        column: str,
+        value: str,
+        source: str = None,
+        chunks: list[str] = None,
+    ) -> None:
+        # Keep the other tier of the cache if it's still valid for that file
+        still_valid = "hashes.size=excluded.size"
+        if self.change_in_mtime_invalidates_hash:
+            still_valid += " AND hashes.mtime=excluded.mtime"
+        other_column = "fingerprint" if column == "hash" else "hash"
+
+        algorithm = self.get_algorithm(file)
+
+        # The source is the one of the hash
+        if column == "hash":
+            with self.lock:
+                provided_source = self.hash_sources.pop(file.fullpath, None)
+                computed_chunks = self.hash_chunks.pop(file.fullpath, None)
+            source = source or provided_source or "computed"
+            chunks = chunks or computed_chunks
+            source_update = "excluded.source"
+        else:
+            source = None
+            source_update = f"CASE WHEN {still_valid} THEN hashes.source ELSE NULL END"
 
-        return True
+        self.database.execute(
+            f"""
+            INSERT INTO hashes(fullpath, algorithm, {column}, size, mtime, device, inode, source) VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(fullpath, algorithm) DO UPDATE SET
+                {column}=excluded.{column},
+                {other_column}=CASE WHEN {still_valid} THEN hashes.{other_column} ELSE NULL END,
+                source={source_update},
+                size=excluded.size,
+                mtime=excluded.mtime,
+                device=excluded.device,
+                inode=excluded.inode
+            """,
+            (
+                file.fullpath,
+                algorithm,
+                value,
+                file.get_size(),
+                file.get_mtime(),
+                file.get_device(),
+                file.get_inode(),
+                source,
+            ),
+        )
+
+        if column == "hash" and algorithm != self.hash_algorithm:
+            self.database.execute(
+                "DELETE FROM hash_chunks WHERE fullpath=? AND algorithm=?",
+                (file.fullpath, algorithm),
+            )
+            if chunks is not None:
+                self.database.executemany(
+                    "INSERT INTO hash_chunks(fullpath, algorithm, chunk, hash) VALUES(?, ?, ?, ?)",
+                    [
+                        (file.fullpath, algorithm, index, chunk)
+                        for index, chunk in enumerate(chunks)
+                    ],
+                )
+        self.database.commit()
+
+    def get_cached_chunks(self, file: File) -> list[str] | None:
+        # Returns the chunks of the cached hash of that file, if it has been hashed with the hash tree
+        algorithm = self.get_algorithm(file)
+        if algorithm == self.hash_algorithm:
+            return None
+        file_hash = self.get_cached(file, "hash")
+        if file_hash is None:
+            return None
+
+        chunks = [
+            row[0]
+            for row in self.database.execute(
+                "SELECT hash FROM hash_chunks WHERE fullpath=? AND algorithm=? ORDER BY chunk",
+                (file.fullpath, algorithm),
+            )
+        ]
+        # The hash might have been replaced since (eg. imported from another host)
+        if self.hash_tree.get_root(file.get_size(), chunks) != file_hash:
+            return None
+        return chunks
+
+    def new_hasher(self, file: File, expected_chunks: list[str] = None):
+        # Hashes the content of that file while it's read by something else (eg. copied)
+        if self.get_algorithm(file) != self.hash_algorithm:
+            return self.hash_tree.new_hasher(expected_chunks)
+        return HashAlgorithms.new(self.hash_algorithm)
+
+    def get_fingerprint(self, file: File) -> str:
+        return self.get_fingerprints([file])[file.fullpath]
+
+    def get_fingerprints(self, files: list[File]) -> dict[str, str]:
+        return self.get_cached_or_compute(
+            files, "fingerprint", self.compute_fingerprint
+        )
 
     def get_hash(self, file: File) -> str:
-        # Check if the hash is in the cache
+        return self.get_hashes([file])[file.fullpath]
+
+    def get_hashes(self, files: list[File]) -> dict[str, str]:
+        return self.get_cached_or_compute(files, "hash", self.timed_compute_hash)
+
+    def get_cached_or_compute(
+        self, files: list[File], column: str, compute: Callable[[File], str]
+    ) -> dict[str, str]:
+        # Returns the values by fullpath, computing the ones missing from the cache concurrently
+        values = {}
+        futures = {}
+        for file in files:
+            if file.fullpath in values or file.fullpath in futures:
+                continue
+
+            value_in_cache = self.get_cached(file, column)
+            if value_in_cache is not None:
+                values[file.fullpath] = value_in_cache
+            else:
+                futures[file.fullpath] = (file, self.hash_executor.submit(file, compute))
+
+        # The database must only be used from this thread, so store the results here
+        error = None
+        for fullpath, (file, future) in futures.items():
+            try:
+                values[fullpath] = future.result()
+                self.logger.debug(f"{column.capitalize()} {values[fullpath]} for {fullpath}")
+                self.store_in_cache(file, column, values[fullpath])
+            except Exception as e:
+                error = error or e
+
+        if error is not None:
+            raise error
+        return values
+
+    def prefetch(self, pending: list[tuple[File, list[File]]]) -> None:
+        # Hash several pending files at once, so the following checks are served from the cache
+        # Only the files which would be hashed anyway by can_be_replaced_with are hashed
+        if not self.check_hash:
+            return
+
+        try:
+            fingerprints = {}
+            if self.check_fingerprint:
+                fingerprints = self.get_fingerprints(
+                    [
+                        file
+                        for original, candidates in pending
+                        for file in [original] + candidates
+                    ]
+                )
 
-        query = f"SELECT hash FROM hashes WHERE fullpath=? AND size={file.get_size()}"
-        if self.change_in_mtime_invalidates_hash:
-            query += f" AND mtime={file.get_mtime()}"
+            to_hash = []
+            for original, candidates in pending:
+                for candidate in candidates:
+                    if self.is_excluded_target(candidate):
+                        continue
+                    if fingerprints.get(original.fullpath) != fingerprints.get(
+                        candidate.fullpath
+                    ):
+                        continue
+                    to_hash += [original, candidate]
+                    break
 
-        cursor = self.database.execute(query, (file.fullpath,))
+            self.get_hashes(to_hash)
+        except Exception as e:
+            # Will be raised again, and properly reported, when checking that file
+            self.logger.debug(f"An exception occured while prefetching hashes: {e}")
+
+    def get_limiter(self, file: File) -> IoLimiter | None:
+        # Reads from the target directories might be throttled
+        if self.io_scheduler is None:
+            return None
+        return self.io_scheduler.get_limiter(file.fullpath, "hashing")
+
+    def get_location(self, limiter: IoLimiter | None) -> str:
+        # Files in the target directories are usually on a remote mount
+        return "local" if limiter is None else "remote"
+
+    def compute_fingerprint(self, file: File) -> str:
+        # Hash the size and samples at the beginning, middle and end of the file
+        # Prefixed with the sample size, so fingerprints taken with different ones never match
+        size = file.get_size()
+        sample_size = self.fingerprint_sample_size
+        offsets = sorted(
+            set([0, max(0, (size - sample_size) // 2), max(0, size - sample_size)])
+        )
 
-        hash_in_cache = cursor.fetchone()
-        if hash_in_cache is not None:
-            return hash_in_cache[0]
+        limiter = self.get_limiter(file)
+        m = HashAlgorithms.new(self.hash_algorithm)
+        m.update(str(size).encode())
+        if limiter is not None:
+            limiter.opened()
+        with (
+            self.profiler.span("fingerprint", file=file.fullpath),
+            open(file.fullpath, "rb") as f,
+        ):
+            for offset in offsets:
+                f.seek(offset)
+                buf = f.read(sample_size)
+                if limiter is not None:
+                    limiter.read(len(buf))
+                m.update(buf)
+                self.metrics.increment(
+                    "hashed_bytes_total",
+                    len(buf),
+                    column="fingerprint",
+                    location=self.get_location(limiter),
+                )
+
+        return f"{sample_size}:{m.hexdigest()}"
+
+    def get_provided_hash(
+        self, file: File, stop: threading.Event = None
+    ) -> str | None:
+        # Runs in the hash executor threads: returns the checksum from the first source that knows it
+        # A sample of them is verified by actually hashing the file
+        if not self.checksum_sources.is_enabled():
+            return None
+        if self.get_algorithm(file) != self.hash_algorithm:
+            return None  # Only plain hashes are ever provided
+        # Only for the target directories: the originals are deleted when they match, and a checksum
+        # left over from before they were rewritten in place would make them match the old content
+        limiter = self.get_limiter(file)
+        if limiter is None:
+            return None
+
+        provided = self.checksum_sources.get(file, limiter)
+        if provided is None:
+            return None
+
+        file_hash, source = provided
+        self.logger.debug(f"Hash {file_hash} of {file.fullpath} provided by {source}")
+        if random.random() < self.checksum_sources.verify_sample_ratio:
+            computed_hash = self.compute_hash(file, stop)
+            if computed_hash != file_hash:
+                self.logger.warning(
+                    f"The hash of {file.fullpath} provided by {source} is wrong ({file_hash} instead of {computed_hash}), using the computed one"
+                )
+                self.metrics.increment("provided_hash_verifications_total", result="mismatch")
+                return computed_hash
+            self.metrics.increment("provided_hash_verifications_total", result="match")
+
+        self.metrics.increment("provided_hashes_total", source=source.split(":")[0])
+        with self.lock:
+            self.hash_sources[file.fullpath] = source
+        return file_hash
+
+    def timed_compute_hash(self, file: File) -> str:
+        provided_hash = self.get_provided_hash(file)
+        if provided_hash is not None:
+            return provided_hash
 
-        # Get the hash an populate the cache
         self.logger.info(
             f"Could not find the hash of {file.fullpath} in the cache, computing it, this will take a while"
         )
@@ -145,37 +607,71 @@ class Checker:
         self.logger.info(
             f"Computing the hash of {file.fullpath} ({file_hash}) took {end_time - start_time} seconds"
         )
-
-        self.database.execute(
-            "INSERT OR REPLACE INTO hashes(fullpath, hash, size, mtime) VALUES(?, ?, ?, ?)",
-            (file.fullpath, file_hash, file.get_size(), file.get_mtime()),
-        )
-        self.database.commit()
-
         return file_hash
 
-    def compute_hash(self, file: File) -> str:
+    def compute_hash(self, file: File, stop: threading.Event = None) -> str:
+        # Setting stop interrupts the computation (with an exception) before reading the next block
+        if self.get_algorithm(file) != self.hash_algorithm:
+            return self.compute_tree_hash(file, stop)
+
         # This is much more expensive for no good reason and can't print progress
         # with open(fullpath, "rb", buffering=0) as f:
         #     return hashlib.file_digest(f, "sha256").hexdigest()
 
         blocksize = 2**20
         total_rounds = file.get_size() / blocksize
-        print_progress_every = round(total_rounds / 10)
-
-        m = hashlib.md5()
-        with open(file.fullpath, "rb") as f:
+        print_progress_every = max(1, round(total_rounds / 10))
+
+        limiter = self.get_limiter(file)
+        m = HashAlgorithms.new(self.hash_algorithm)
+        if limiter is not None:
+            limiter.opened()
+        hashed_bytes = 0
+        with (
+            self.profiler.span("hash", file=file.fullpath),
+            open(file.fullpath, "rb") as f,
+        ):
             index: int = 0
             while True:
+                if stop is not None and stop.is_set():
+                    raise Exception(f"Hashing of {file.fullpath} interrupted")
                 buf = f.read(blocksize)
                 if not buf:
-                    print("", flush=True)
                     break
+                if limiter is not None:
+                    limiter.read(len(buf))
                 m.update(buf)
-                print(".", end="", flush=True)
 
+                hashed_bytes += len(buf)
+
+                # Several files can be hashed at once, so don't print dots that would get mixed up
                 index += 1
                 if (index % print_progress_every) == 0:
-                    print(f" {round(index / total_rounds * 100)}%", flush=True)
-
+                    self.logger.debug(
+                        f"Hashing {file.fullpath}: {min(100, round(index / total_rounds * 100))}%"
+                    )
+
+        self.metrics.increment(
+            "hashed_bytes_total",
+            hashed_bytes,
+            column="hash",
+            location=self.get_location(limiter),
+        )
         return m.hexdigest()
+
+    def compute_tree_hash(self, file: File, stop: threading.Event = None) -> str:
+        # The chunks are kept until the hash is stored in the cache
+        size = file.get_size()
+        limiter = self.get_limiter(file)
+        with self.profiler.span("hash", file=file.fullpath):
+            chunks = self.hash_tree.compute(file.fullpath, size, limiter, stop)
+
+        self.metrics.increment(
+            "hashed_bytes_total",
+            size,
+            column="hash",
+            location=self.get_location(limiter),
+        )
+        with self.lock:
+            self.hash_chunks[file.fullpath] = chunks
+        return self.hash_tree.get_root(size, chunks)
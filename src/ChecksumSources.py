@@ -0,0 +1,108 @@
+import logging
+import os
+import re
+
+from src.File import File
+from src.HashAlgorithms import HashAlgorithms
+from src.IoScheduler import IoLimiter
+
+"""
+Checksums that are already known for a file, so it doesn't have to be read entirely to get its hash:
+extended attributes (eg. set by rclone or a previous tool) and sidecar files (file.mkv.md5, MD5SUMS, etc.).
+Only the checksums computed with the configured hash-algorithm can be used.
+"""
+
+
+class ChecksumSources:
+    logger = logging.getLogger("ChecksumSources")
+
+    def __init__(self, config: dict, hash_algorithm: str):
+        self.config = config
+        self.hash_algorithm = hash_algorithm
+        self.hash_length = HashAlgorithms.new(hash_algorithm).digest_size * 2
+        self.hash_regex = re.compile(f"^[0-9a-fA-F]{{{self.hash_length}}}$")
+
+        # Sources with another algorithm can't be compared with what we compute
+        self.xattrs = [
+            x["name"] for x in config["xattrs"] if x["algorithm"] == hash_algorithm
+        ]
+        self.sidecars = [
+            s["pattern"] for s in config["sidecars"] if s["algorithm"] == hash_algorithm
+        ]
+        ignored = (
+            len(config["xattrs"])
+            + len(config["sidecars"])
+            - len(self.xattrs)
+            - len(self.sidecars)
+        )
+        if ignored > 0:
+            self.logger.warning(
+                f"Ignoring {ignored} checksum sources which are not using the {hash_algorithm} hash algorithm"
+            )
+
+        self.verify_sample_ratio = config["verify-sample-ratio"]
+
+    def is_enabled(self) -> bool:
+        return len(self.xattrs) > 0 or len(self.sidecars) > 0
+
+    def get(self, file: File, limiter: IoLimiter | None) -> tuple[str, str] | None:
+        # Returns the checksum and where it comes from, or None if it's not known
+        for name in self.xattrs:
+            checksum = self.get_from_xattr(file, name)
+            if checksum is not None:
+                return checksum, f"xattr:{name}"
+
+        for pattern in self.sidecars:
+            path = self.get_sidecar_path(file, pattern)
+            checksum = self.get_from_sidecar(file, path, limiter)
+            if checksum is not None:
+                return checksum, f"sidecar:{path}"
+
+        return None
+
+    def get_from_xattr(self, file: File, name: str) -> str | None:
+        try:
+            value = os.getxattr(file.fullpath, name).decode("ascii").strip()
+        except (AttributeError, OSError, UnicodeDecodeError):
+            return None  # Not supported on this platform or filesystem, or not set
+        return self.parse(value)
+
+    def get_sidecar_path(self, file: File, pattern: str) -> str:
+        filename = file.get_filename()
+        return pattern.format(
+            fullpath=file.fullpath,
+            directory=os.path.dirname(file.fullpath),
+            filename=filename,
+            stem=os.path.splitext(filename)[0],
+        )
+
+    def get_from_sidecar(
+        self, file: File, path: str, limiter: IoLimiter | None
+    ) -> str | None:
+        # One checksum alone, or "<checksum>  <filename>" lines like md5sum/sha256sum output
+        try:
+            # A sidecar older than the file is about a previous version of it
+            if round(os.stat(path).st_mtime) < file.get_mtime():
+                self.logger.debug(f"Ignoring {path}, it's older than {file.fullpath}")
+                return None
+
+            if limiter is not None:
+                limiter.opened()
+            with open(path, "r", errors="replace") as f:
+                lines = f.read(2**20).splitlines()
+        except OSError:
+            return None
+
+        filename = file.get_filename()
+        for line in lines:
+            fields = line.strip().split(maxsplit=1)
+            if len(fields) == 1 and len(lines) == 1:
+                return self.parse(fields[0])
+            if len(fields) == 2 and os.path.basename(fields[1].lstrip("*")) == filename:
+                return self.parse(fields[0])
+        return None
+
+    def parse(self, value: str) -> str | None:
+        if self.hash_regex.match(value) is None:
+            return None
+        return value.lower()
@@ -0,0 +1,147 @@
+import errno
+import logging
+import os
+import time
+
+from src.IoScheduler import IoLimiter
+
+"""
+Copy file contents with large buffers, hashing them on the way so they don't have to be read again to be verified.
+When no hash is needed, the copy is done by the kernel (copy_file_range or sendfile) when possible.
+"""
+
+
+class Copier:
+    logger = logging.getLogger("Copier")
+
+    # Errors meaning the kernel can't do that copy, so the next method should be tried
+    unsupported_errors = (
+        errno.EXDEV,
+        errno.ENOSYS,
+        errno.EINVAL,
+        errno.EOPNOTSUPP,
+        errno.EBADF,
+        errno.EPERM,
+    )
+
+    def __init__(self, buffer_size: int = 8 * 2**20):
+        self.buffer_size = max(2**16, buffer_size)
+
+    def copy(
+        self,
+        source: str,
+        destination: str,
+        hasher=None,
+        offset: int = 0,
+        limiter: IoLimiter = None,
+    ) -> str | None:
+        # Copy source to destination, keeping the first offset bytes already in destination (resume)
+        # Returns the hash of the whole destination content if a hasher is given (a hashlib object or a TreeHasher)
+        # The reads from source are throttled by the limiter, if any
+        m = hasher
+
+        start_time = time.perf_counter()
+        if limiter is not None:
+            limiter.opened()
+        with (
+            open(source, "rb", buffering=0) as src,
+            open(destination, "r+b" if offset > 0 else "wb", buffering=0) as dst,
+        ):
+            if offset > 0:
+                dst.truncate(offset)
+                if m is not None:
+                    # Reading back the local partial copy is much cheaper than reading the source again
+                    self.copy_buffered(dst, None, m, None)
+                src.seek(offset)
+                dst.seek(offset)
+
+            if m is not None:
+                self.copy_buffered(src, dst, m, limiter)
+            else:
+                self.copy_in_kernel(src.fileno(), dst.fileno(), offset, limiter)
+
+            copied_bytes = os.fstat(dst.fileno()).st_size - offset
+
+        duration = time.perf_counter() - start_time
+        self.logger.info(
+            f"Copied {round(copied_bytes / 10**6)} MB from {source} in {duration:.1f} seconds ({copied_bytes / 10**6 / max(duration, 0.001):.1f} MB/s)"
+            + (f", resumed after {round(offset / 10**6)} MB" if offset > 0 else "")
+        )
+
+        return m.hexdigest() if m is not None else None
+
+    def copy_buffered(self, src, dst, m, limiter: IoLimiter | None) -> None:
+        # dst can be None to only hash src
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        while True:
+            read = src.readinto(buffer)
+            if not read:
+                break
+            if limiter is not None:
+                limiter.read(read)
+            # Written before being hashed, so what has been verified when the hasher raises is on disk
+            if dst is not None:
+                written = 0
+                while written < read:
+                    written += dst.write(view[written:read])
+            m.update(view[:read])
+
+    def copy_in_kernel(
+        self, src_fd: int, dst_fd: int, offset: int, limiter: IoLimiter | None
+    ) -> None:
+        for method in (self.copy_file_range, self.sendfile):
+            # Start from where the previous method stopped
+            position = max(offset, os.fstat(dst_fd).st_size)
+            try:
+                method(src_fd, dst_fd, position, limiter)
+                return
+            except (OSError, AttributeError) as e:
+                if isinstance(e, OSError) and e.errno not in self.unsupported_errors:
+                    raise
+                self.logger.debug(f"Could not copy using {method.__name__}: {e}")
+
+        position = max(offset, os.fstat(dst_fd).st_size)
+        os.lseek(src_fd, position, os.SEEK_SET)
+        os.lseek(dst_fd, position, os.SEEK_SET)
+        with (
+            open(src_fd, "rb", buffering=0, closefd=False) as src,
+            open(dst_fd, "wb", buffering=0, closefd=False) as dst,
+        ):
+            buffer = bytearray(self.buffer_size)
+            view = memoryview(buffer)
+            while True:
+                read = src.readinto(buffer)
+                if not read:
+                    break
+                if limiter is not None:
+                    limiter.read(read)
+                written = 0
+                while written < read:
+                    written += dst.write(view[written:read])
+
+    def copy_file_range(
+        self, src_fd: int, dst_fd: int, position: int, limiter: IoLimiter | None
+    ) -> None:
+        # Lets the filesystem clone or copy the data server side, without going through userspace
+        while True:
+            copied = os.copy_file_range(
+                src_fd, dst_fd, self.buffer_size, position, position
+            )
+            if copied == 0:
+                return
+            if limiter is not None:
+                limiter.read(copied)
+            position += copied
+
+    def sendfile(
+        self, src_fd: int, dst_fd: int, position: int, limiter: IoLimiter | None
+    ) -> None:
+        os.lseek(dst_fd, position, os.SEEK_SET)
+        while True:
+            copied = os.sendfile(dst_fd, src_fd, position, self.buffer_size)
+            if copied == 0:
+                return
+            if limiter is not None:
+                limiter.read(copied)
+            position += copied
@@ -0,0 +1,261 @@
+import logging
+import sqlite3
+import threading
+import time
+
+from src.File import File
+from src.Walker import WalkedDirectory
+
+"""
+Remember what happened in each watched directory, so the directories that didn't change since the last cycle
+are not listed again, and their files not checked again.
+A directory is only recorded once all its files have been processed, so an interrupted cycle resumes
+where it stopped: the directories that were not finished are listed again.
+"""
+
+
+class DirectorySnapshot:
+    __slots__ = (
+        "path",
+        "parent",
+        "mtime",
+        "subdirectories",
+        "entries",
+        "outstanding",
+        "pending",
+        "revisit_after",
+        "listed",
+    )
+
+    def __init__(self, walked: WalkedDirectory):
+        self.path = walked.path
+        self.parent = walked.parent
+        self.mtime = walked.mtime
+        self.subdirectories = walked.subdirectories
+        self.entries = len(walked.files)
+        self.outstanding = 0  # Eligible files not processed yet
+        self.pending = 0  # Eligible files that couldn't be replaced (no candidate, different hashes, errors)
+        self.revisit_after: int | None = None  # When the files too young to be replaced will be old enough
+        self.listed = False  # All the files of the directory have been seen
+
+
+class DirectorySnapshots:
+    logger = logging.getLogger("DirectorySnapshots")
+
+    # Completed directories are written to the database by batches of that many
+    flush_every: int = 100
+
+    def __init__(
+        self,
+        database: sqlite3.Connection,
+        incremental: bool = True,
+        full_rescan_every_cycles: int = 0,
+        settings: str = "",
+    ):
+        self.database = database
+        self.incremental = incremental
+        self.full_rescan_every_cycles = full_rescan_every_cycles
+        # The settings deciding which files are eligible, the snapshots taken with other ones can't be trusted
+        self.settings = settings
+        self.lock = threading.Lock()
+
+        self.known: dict[str, tuple] = {}
+        self.files: dict[str, DirectorySnapshot] = {}  # Eligible files being processed
+        self.completed: list[DirectorySnapshot] = []
+        self.seen: list[str] = []  # Unchanged directories, which are not listed
+        self.full_rescan = True
+        self.index_generation = 0
+        self.cycle = 0
+        self.unchanged_directories = 0
+        # The files too young to be replaced are only known in memory: list their directories again
+        # until a whole cycle went through, so they are known again after a restart
+        self.list_young_directories = True
+
+        self.create_snapshots_table()
+
+    def create_snapshots_table(self) -> None:
+        self.database.execute("""
+            CREATE TABLE IF NOT EXISTS finder_directories (
+                directory VARCHAR PRIMARY KEY,
+                parent VARCHAR,
+                mtime LONG,
+                subdirectories VARCHAR,
+                entries INT,
+                pending INT,
+                revisit_after LONG,
+                index_generation INT,
+                cycle INT
+            );
+        """)
+        self.database.execute("""
+            CREATE TABLE IF NOT EXISTS finder_state (
+                key VARCHAR PRIMARY KEY,
+                value VARCHAR
+            );
+        """)
+        self.database.commit()
+
+    def get_state(self, key: str) -> str | None:
+        row = self.database.execute(
+            "SELECT value FROM finder_state WHERE key=?", (key,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def set_state(self, key: str, value: str) -> None:
+        self.database.execute(
+            "INSERT OR REPLACE INTO finder_state(key, value) VALUES(?, ?)",
+            (key, value),
+        )
+
+    def start_cycle(self, index_generation: int) -> None:
+        # index_generation is the last generation in which the index changed: directories with files
+        # that couldn't be replaced must be checked again when it changes, as there might be new candidates
+        self.index_generation = index_generation
+
+        # Forget everything when the settings changed, so an interrupted cycle doesn't resume from stale snapshots
+        if self.get_state("settings") != self.settings:
+            self.logger.info(
+                "The settings deciding which files are eligible changed, forgetting the snapshots of the watched directories"
+            )
+            self.database.execute("DELETE FROM finder_directories")
+            self.set_state("settings", self.settings)
+            self.database.commit()
+
+        self.cycle = (
+            self.database.execute(
+                "SELECT MAX(cycle) FROM finder_directories"
+            ).fetchone()[0]
+            or 0
+        ) + 1
+
+        self.full_rescan = not self.incremental or (
+            self.full_rescan_every_cycles > 0
+            and self.cycle % self.full_rescan_every_cycles == 0
+        )
+        if self.full_rescan:
+            self.logger.info("Listing all the watched directories again")
+
+        self.known = {}
+        if not self.full_rescan:
+            for row in self.database.execute(
+                "SELECT directory, mtime, subdirectories, pending, revisit_after, index_generation FROM finder_directories"
+            ):
+                self.known[row[0]] = row[1:]
+
+        self.files = {}
+        self.completed = []
+        self.seen = []
+        self.unchanged_directories = 0
+
+    def reuse_listing(self, path: str, mtime: int) -> list[str] | None:
+        # Called by the walker threads: returns the subdirectories of a directory that doesn't need to be listed
+        known = self.known.get(path)
+        if known is None:
+            return None
+
+        known_mtime, subdirectories, pending, revisit_after, index_generation = known
+        if known_mtime != mtime:
+            return None
+        if revisit_after is not None and (
+            revisit_after <= time.time() or self.list_young_directories
+        ):
+            return None
+        if pending > 0 and index_generation < self.index_generation:
+            return None
+
+        return subdirectories.split("\0") if subdirectories else []
+
+    def begin(self, walked: WalkedDirectory) -> DirectorySnapshot:
+        return DirectorySnapshot(walked)
+
+    def add_file(self, snapshot: DirectorySnapshot, file: File) -> None:
+        with self.lock:
+            snapshot.outstanding += 1
+            self.files[file.fullpath] = snapshot
+
+    def revisit(self, snapshot: DirectorySnapshot, revisit_after: int) -> None:
+        # List the directory again after that time even if it didn't change, eg. when a file becomes old enough
+        with self.lock:
+            if snapshot.revisit_after is None or revisit_after < snapshot.revisit_after:
+                snapshot.revisit_after = revisit_after
+
+    def end_listing(self, snapshot: DirectorySnapshot) -> None:
+        with self.lock:
+            snapshot.listed = True
+            if snapshot.outstanding == 0:
+                self.completed.append(snapshot)
+
+    def skip(self, walked: WalkedDirectory) -> None:
+        with self.lock:
+            self.unchanged_directories += 1
+            self.seen.append(walked.path)
+
+    def file_done(self, file: File, replaced: bool, retry: bool = False) -> None:
+        # retry lists the directory again next cycle whatever happens to the index,
+        # for the files that might be replaced then (errors, dry runs)
+        with self.lock:
+            snapshot = self.files.pop(file.fullpath, None)
+            if snapshot is None:
+                return  # Not found while walking (eg. inotify)
+
+            snapshot.outstanding -= 1
+            if not replaced:
+                snapshot.pending += 1
+            if retry:
+                now = round(time.time())
+                if snapshot.revisit_after is None or now < snapshot.revisit_after:
+                    snapshot.revisit_after = now
+            if snapshot.listed and snapshot.outstanding == 0:
+                self.completed.append(snapshot)
+
+    def flush(self, force: bool = True) -> None:
+        # The database is only used from the main thread, the other threads only queue the updates
+        with self.lock:
+            if not force and len(self.completed) + len(self.seen) < self.flush_every:
+                return
+            completed, self.completed = self.completed, []
+            seen, self.seen = self.seen, []
+        if len(completed) == 0 and len(seen) == 0:
+            return
+
+        self.database.executemany(
+            """
+            INSERT INTO finder_directories(directory, parent, mtime, subdirectories, entries, pending, revisit_after, index_generation, cycle)
+            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(directory) DO UPDATE SET
+                parent=excluded.parent, mtime=excluded.mtime, subdirectories=excluded.subdirectories,
+                entries=excluded.entries, pending=excluded.pending, revisit_after=excluded.revisit_after,
+                index_generation=excluded.index_generation, cycle=excluded.cycle
+            """,
+            (
+                (
+                    s.path,
+                    s.parent,
+                    s.mtime,
+                    "\0".join(s.subdirectories),
+                    s.entries,
+                    s.pending,
+                    s.revisit_after,
+                    self.index_generation,
+                    self.cycle,
+                )
+                for s in completed
+            ),
+        )
+        self.database.executemany(
+            "UPDATE finder_directories SET cycle=? WHERE directory=?",
+            ((self.cycle, path) for path in seen),
+        )
+        self.database.commit()
+
+    def end_cycle(self) -> None:
+        # Only called when the whole walk went through: what hasn't been seen is gone
+        self.flush()
+        self.list_young_directories = False
+        deleted = self.database.execute(
+            "DELETE FROM finder_directories WHERE cycle<?", (self.cycle,)
+        ).rowcount
+        self.database.commit()
+        self.logger.info(
+            f"Skipped {self.unchanged_directories} unchanged directories, forgot {deleted} directories which are not there anymore"
+        )
@@ -0,0 +1,396 @@
+import argparse
+import copy
+import hashlib
+import logging
+import os
+import pprint
+import shutil
+import sqlite3
+import time
+from typing import Callable
+
+import yaml
+
+from src.Checker import Checker
+from src.Finder import Finder
+from src.HashAlgorithms import HashAlgorithms
+from src.HashExchange import HashExchange
+from src.Indexer import Indexer
+from src.IoScheduler import IoScheduler
+from src.Metrics import ErrorCounter, Metrics
+from src.PreHasher import PreHasher
+from src.Profiler import Profiler
+from src.Replacer import Replacer
+from src.Retargeter import Retargeter
+from src.Watcher import Watcher
+
+"""
+Keep the database connection and the components (with their compiled exclusions, thread pools and caches)
+from one run to the next in watch mode. The config file is only read again when it changed on disk,
+and only the components using a part of the config that changed are rebuilt.
+"""
+
+
+def merge(source, destination):
+    if source is not None:
+        for key, value in source.items():
+            if isinstance(value, dict):
+                node = destination.setdefault(key, {})
+                merge(value, node)
+            else:
+                destination[key] = value
+
+    return destination
+
+
+class Engine:
+    logger = logging.getLogger("Engine")
+
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        config_default_file: str,
+        config_arg_file: str,
+        database_file: str = None,
+        log_level: str = None,
+        dry_run: str = None,
+    ):
+        self.args = args
+        self.config_default_file = config_default_file
+        self.config_arg_file = config_arg_file
+        self.database_file = database_file
+        self.log_level = log_level
+        self.dry_run = dry_run
+
+        self.config: dict = None
+        self.config_stats: dict[str, tuple] = {}  # Path => (mtime, size) when last read
+        self.config_hash: str = None
+
+        self.database: sqlite3.Connection = None
+        self.database_path: str = None
+        # Name => component, and what it was built from
+        self.components: dict[str, object] = {}
+        self.built_from: dict[str, tuple] = {}
+        self.watcher: Watcher = None
+
+        self.error_counter = ErrorCounter(Metrics())
+        logging.getLogger().addHandler(self.error_counter)
+        self.metrics = Metrics()
+        self.profiler = Profiler()
+
+    def reload_config(self) -> bool:
+        # Returns whether the config changed, it's only read again when a file has been modified
+        # Create configuration file if it doesn't exist
+        if not os.path.isfile(self.config_arg_file):
+            self.logger.warning(
+                f"Configuration not found, creating a base one at {self.config_arg_file}"
+            )
+            shutil.copy("config_override_base.yml", self.config_arg_file)
+
+        paths = [self.config_default_file, self.config_arg_file]
+        stats = {}
+        for path in paths:
+            stat = os.stat(path)
+            stats[path] = (stat.st_mtime_ns, stat.st_size)
+        if self.config is not None and stats == self.config_stats:
+            return False
+        self.config_stats = stats
+
+        # Touching the file without changing it is not a change
+        contents = []
+        for path in paths:
+            with open(path, "rb") as config_file:
+                contents.append(config_file.read())
+        config_hash = hashlib.sha256(b"\0".join(contents)).hexdigest()
+        if config_hash == self.config_hash:
+            return False
+        self.config_hash = config_hash
+
+        config = yaml.safe_load(contents[0])
+        self.config = merge(yaml.safe_load(contents[1]), config)
+        self.logger.info(f"Configuration: {pprint.pformat(self.config)}")
+        logging.getLogger().setLevel(self.log_level or self.config["logger"]["level"])
+        return True
+
+    def build(self) -> None:
+        # Components are rebuilt when the part of the config they use, or a component they use, changed
+        config = self.config
+        target_directories = config["finder"]["directories"][
+            "symlink-target-directories"
+        ]
+
+        database_path = self.database_file or config["database"]
+        if self.database is None or database_path != self.database_path:
+            self.close_database()
+            self.database = sqlite3.connect(database_path)
+            self.database_path = database_path
+
+        indexer = self.get_component(
+            "indexer",
+            (
+                config["indexer"],
+                target_directories,
+                config["checker"]["files-min-size-bytes"],
+                config["checker"]["exclusions"]["symlink-target-directories-regexes"],
+            ),
+            (self.database,),
+            lambda: Indexer(
+                config=config["indexer"],
+                target_directories=target_directories,
+                database=self.database,
+                min_size=config["checker"]["files-min-size-bytes"],
+                exclusions=config["checker"]["exclusions"][
+                    "symlink-target-directories-regexes"
+                ],
+                metrics=self.metrics,
+            ),
+        )
+        io_scheduler = self.get_component(
+            "io-scheduler",
+            (config["io-scheduler"], target_directories),
+            (),
+            lambda: IoScheduler(
+                config=config["io-scheduler"],
+                target_directories=target_directories,
+            ),
+        )
+        checker = self.get_component(
+            "checker",
+            (config["checker"],),
+            (self.database, io_scheduler),
+            lambda: Checker(
+                config=config["checker"],
+                database=self.database,
+                io_scheduler=io_scheduler,
+                metrics=self.metrics,
+                profiler=self.profiler,
+            ),
+        )
+        replacer = self.get_component(
+            "replacer",
+            (config["replacer"],),
+            (self.database, checker, io_scheduler),
+            lambda: Replacer(
+                config=config["replacer"],
+                database=self.database,
+                interactive=self.args.interactive,
+                checker=checker,
+                io_scheduler=io_scheduler,
+                metrics=self.metrics,
+            ),
+        )
+        self.get_component(
+            "finder",
+            (config["finder"],),
+            (self.database, indexer, checker, replacer),
+            lambda: Finder(
+                config=config["finder"],
+                database=self.database,
+                indexer=indexer,
+                checker=checker,
+                replacer=replacer,
+                metrics=self.metrics,
+                profiler=self.profiler,
+            ),
+        )
+        self.get_component(
+            "pre-hasher",
+            (config["pre-hasher"], config["finder"]["find-candidates-by"]),
+            (checker, indexer),
+            lambda: PreHasher(
+                config=config["pre-hasher"],
+                checker=checker,
+                indexer=indexer,
+                find_candidates_by=config["finder"]["find-candidates-by"],
+            ),
+        )
+
+        if self.dry_run is not None:
+            # Anything but exactly "false" will be interpreted as a dry run
+            replacer.dry_run = not (self.dry_run.lower() == "false")
+
+    def get_component(
+        self, name: str, settings: tuple, dependencies: tuple, build: Callable
+    ) -> object:
+        # The settings are compared by value (a deep copy is kept), the dependencies must be the same objects
+        built_from = self.built_from.get(name)
+        if (
+            built_from is None
+            or built_from[0] != settings
+            or len(built_from[1]) != len(dependencies)
+            or any(a is not b for a, b in zip(built_from[1], dependencies))
+        ):
+            if built_from is not None:
+                self.logger.info(
+                    f"Rebuilding the {name}, its configuration or a component it uses changed"
+                )
+            self.components[name] = build()
+            self.built_from[name] = (copy.deepcopy(settings), dependencies)
+        return self.components[name]
+
+    def start_run(self) -> None:
+        # Counters and timings of this run, the components keep everything else
+        self.metrics = Metrics(self.config["metrics"])
+        self.error_counter.metrics = self.metrics
+        self.profiler = Profiler(self.args.profile, self.args.trace)
+
+        for component in self.components.values():
+            if hasattr(component, "metrics"):
+                component.metrics = self.metrics
+            if hasattr(component, "profiler"):
+                component.profiler = self.profiler
+
+    def setup_watcher(self) -> None:
+        config = self.config
+        if self.args.action not in ["watch"] or config["watcher"]["mode"] != "inotify":
+            self.watcher = None
+            return
+
+        # Set the watches up before scanning, so nothing changing during the scan is missed
+        try:
+            if self.watcher is None:
+                self.watcher = Watcher(
+                    config=config["watcher"],
+                    min_age=config["checker"]["files-min-age-seconds"],
+                )
+            self.watcher.min_age = config["checker"]["files-min-age-seconds"]
+            self.watcher.set_directories(
+                watch_directories=[
+                    d["dir"] for d in config["finder"]["directories"]["watch-directories"]
+                ],
+                undo_directories=[
+                    d["dir"]
+                    for d in config["finder"]["directories"][
+                        "undo-all-symlinks-directories"
+                    ]
+                ],
+                followlinks=config["finder"]["followlinks"],
+            )
+        except OSError as e:
+            self.logger.warning(
+                f"Could not use inotify, falling back to scanning every interval-seconds: {e}"
+            )
+            self.watcher = None
+
+    def run(self, start_time: int) -> None:
+        self.reload_config()
+        self.setup_watcher()
+        self.build()
+        self.start_run()
+
+        args = self.args
+        config = self.config
+        metrics = self.metrics
+        profiler = self.profiler
+        indexer: Indexer = self.components["indexer"]
+        io_scheduler: IoScheduler = self.components["io-scheduler"]
+        checker: Checker = self.components["checker"]
+        replacer: Replacer = self.components["replacer"]
+        finder: Finder = self.components["finder"]
+
+        if args.action in [
+            "watch",
+            "replace-with-symlinks",
+            "replace-with-content",
+            "retarget-symlinks",
+        ]:
+            with (
+                metrics.timer("phase_seconds", phase="index"),
+                profiler.phase("index"),
+            ):
+                indexer.index_target_directories()
+            if self.watcher is not None:
+                self.watcher.indexed()
+
+        if args.action in ["watch", "replace-with-symlinks"]:
+            with (
+                metrics.timer("phase_seconds", phase="find"),
+                profiler.phase("find"),
+            ):
+                finder.find_and_replace_with_symlinks()
+
+        if args.action in ["watch", "replace-with-content"]:
+            with (
+                metrics.timer("phase_seconds", phase="undo"),
+                profiler.phase("undo"),
+            ):
+                finder.find_and_replace_with_content()
+
+        if args.action in ["retarget-symlinks"]:
+            retargeter = Retargeter(
+                config=config["retargeter"],
+                database=self.database,
+                replacer=replacer,
+                walker=finder.walker,
+                exclusions=checker.exclude_watch_directories,
+                metrics=metrics,
+            )
+            with (
+                metrics.timer("phase_seconds", phase="retarget"),
+                profiler.phase("retarget"),
+            ):
+                retargeter.retarget_symlinks(
+                    [d["dir"] for d in config["finder"]["directories"]["watch-directories"]]
+                )
+
+        if args.action in ["clear-changelog"]:
+            replacer.clear_changelog()
+
+        if args.action in ["clear-hashes"]:
+            checker.clear_hashes_cache()
+
+        if args.action in ["export-hashes", "import-hashes"]:
+            hash_exchange = HashExchange(
+                database=self.database,
+                target_directories=config["finder"]["directories"][
+                    "symlink-target-directories"
+                ],
+                fingerprint_sample_size=checker.fingerprint_sample_size,
+            )
+            if args.action == "export-hashes":
+                hash_exchange.export_hashes(args.hashes_file)
+            else:
+                hash_exchange.import_hashes(args.hashes_file)
+
+        if args.action in ["benchmark-hashes"]:
+            HashAlgorithms.print_benchmark()
+
+        replacer.print_and_delete_dry_run_change()
+        metrics.write()
+
+        if self.watcher is not None:
+            # Process the changed files as they become old enough, until the next full rescan
+            self.watcher.process_events(
+                finder, start_time + config["watcher"]["full-rescan-interval-seconds"]
+            )
+
+        io_scheduler.report()
+        metrics.write()
+        profiler.write_trace()
+
+        # Don't hold a write lock while we sleep
+        self.database.commit()
+
+    def idle(self, next_run: float) -> None:
+        # Called instead of sleeping until the next run in watch mode
+        finder: Finder = self.components["finder"]
+        pre_hasher: PreHasher = self.components["pre-hasher"]
+        pre_hasher.run(list(finder.young_files.values()), next_run)
+        self.metrics.write()
+        self.database.commit()
+
+        sleep_duration = next_run - time.time()
+        if sleep_duration > 0:
+            time.sleep(sleep_duration)
+
+    def close(self) -> None:
+        self.close_database()
+        logging.getLogger().removeHandler(self.error_counter)
+
+    def close_database(self) -> None:
+        # The components using it can't be used anymore
+        if self.database is not None:
+            self.database.close()
+            self.database = None
+        self.components = {}
+        self.built_from = {}
@@ -0,0 +1,79 @@
+import logging
+import os
+import re
+import threading
+
+"""
+Exclusion regexes compiled into a single matcher, which can be used to prune whole directories
+while walking, so excluded subtrees are never listed.
+"""
+
+
+class Exclusions:
+    logger = logging.getLogger("Exclusions")
+
+    # Backreferences (\1) and conditionals ((?(1)...)) by group number
+    numbered_reference = re.compile(r"\\[1-9]|\(\?\([0-9]")
+
+    def __init__(self, regexes: list[str]):
+        self.patterns = [re.compile(r) for r in regexes]
+
+        # A single regex is much faster than trying them all, but inline flags can prevent combining them,
+        # and the groups are renumbered in the combined one, so numbered references would point to the wrong group
+        self.matcher = None
+        if len(regexes) > 0 and not any(
+            self.numbered_reference.search(r) for r in regexes
+        ):
+            try:
+                self.matcher = re.compile("|".join(f"(?:{r})" for r in regexes))
+            except re.error:
+                self.matcher = None
+
+        # Counters, for verification (updated from the walker threads)
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters(self) -> None:
+        with self.lock:
+            self.pruned_directories = 0
+            self.excluded_files = 0
+
+    def get_matching_pattern(self, fullpath: str) -> str | None:
+        if len(self.patterns) == 0:
+            return None
+        if self.matcher is not None and not self.matcher.match(fullpath):
+            return None
+
+        for pattern in self.patterns:
+            if pattern.match(fullpath):
+                return pattern.pattern
+        return None
+
+    def is_file_excluded(self, fullpath: str) -> bool:
+        pattern = self.get_matching_pattern(fullpath)
+        if pattern is None:
+            return False
+
+        with self.lock:
+            self.excluded_files += 1
+        self.logger.debug(
+            f"Ignoring file {fullpath}, matching exclusion regex '{pattern}'"
+        )
+        return True
+
+    def is_directory_excluded(self, path: str) -> bool:
+        # Directories are matched with a trailing separator, so a regex like "/data/movies/foo/.*"
+        # excludes the directory itself and everything below it
+        pattern = self.get_matching_pattern(path.rstrip(os.sep) + os.sep)
+        if pattern is None:
+            return False
+
+        with self.lock:
+            self.pruned_directories += 1
+        self.logger.debug(
+            f"Not walking directory {path}, matching exclusion regex '{pattern}'"
+        )
+        return True
+
+    def get_counters(self) -> str:
+        return f"{self.pruned_directories} directories pruned and {self.excluded_files} files excluded"
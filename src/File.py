@@ -2,38 +2,94 @@ import os
 
 
 class File:
-    __filename: str = None
-    __mtime = None
-    __size: int = None
-    __readlink: str = None
+    # Each stat can be a network round trip on remote mounts, so it's done at most once per File,
+    # or not at all when the walker already did it
+    __slots__ = (
+        "fullpath",
+        "_filename",
+        "_size",
+        "_mtime",
+        "_device",
+        "_inode",
+        "_is_link",
+        "_readlink",
+    )
 
-    def __init__(self, fullpath: str):
+    def __init__(
+        self,
+        fullpath: str,
+        stat: os.stat_result = None,
+        is_link: bool = None,
+    ):
         self.fullpath = fullpath
+        self._filename: str = None
+        self._size: int = None
+        self._mtime: int = None
+        self._device: int = None
+        self._inode: int = None
+        self._is_link: bool = is_link
+        self._readlink: str = None
+
+        if stat is not None:
+            self.set_stat(stat)
+
+    @classmethod
+    def from_dir_entry(cls, entry: os.DirEntry) -> "File":
+        # The stat of a DirEntry is cached, and done by the walker threads
+        file = cls(entry.path, is_link=entry.is_symlink())
+        file._filename = entry.name
+        if not file._is_link:
+            # Same as following the symlinks for anything which isn't a symlink
+            try:
+                file.set_stat(entry.stat(follow_symlinks=False))
+            except OSError:
+                pass  # Will be raised again when the stat is actually needed
+        return file
+
+    def set_stat(self, stat: os.stat_result) -> None:
+        self._size = stat.st_size
+        self._mtime = round(stat.st_mtime)
+        self._device = stat.st_dev
+        self._inode = stat.st_ino
+
+    def load_stat(self) -> None:
+        # Follow symlinks, we want to know about what they are pointing to
+        if self._size is None:
+            self.set_stat(os.stat(self.fullpath))
 
     def get_filename(self) -> str:
-        if self.__filename is None:
-            self.__filename = os.path.basename(self.fullpath)
-        return self.__filename
+        if self._filename is None:
+            self._filename = os.path.basename(self.fullpath)
+        return self._filename
 
     def get_mtime(self) -> int:
-        if self.__mtime is None:
-            self.__mtime = round(os.path.getmtime(self.fullpath))
-        return self.__mtime
+        self.load_stat()
+        return self._mtime
 
     def get_size(self) -> int:
-        if self.__size is None:
-            self.__size = os.path.getsize(self.fullpath)
-        return self.__size
+        self.load_stat()
+        return self._size
+
+    def get_device(self) -> int:
+        self.load_stat()
+        return self._device
+
+    def get_inode(self) -> int:
+        self.load_stat()
+        return self._inode
 
     def get_readlink(self) -> str:
-        if self.__readlink is None:
-            self.__readlink = os.readlink(self.fullpath)
-        return self.__readlink
+        if self._readlink is None:
+            self._readlink = os.readlink(self.fullpath)
+        return self._readlink
 
     def is_link(self) -> bool:
-        return os.path.islink(self.fullpath)
+        if self._is_link is None:
+            self._is_link = os.path.islink(self.fullpath)
+        return self._is_link
 
     def is_file(self) -> bool:
+        # Not cached, this is used to check if temporary files exist
         return os.path.isfile(self.fullpath)
 
     def remove(self) -> None:
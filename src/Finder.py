@@ -1,11 +1,18 @@
 import logging
-import os
 import sqlite3
+import time
+from typing import Callable, Iterator
 
 from src.Checker import Checker
+from src.DirectorySnapshots import DirectorySnapshots
 from src.File import File
 from src.Indexer import Indexer
+from src.Metrics import Metrics
+from src.Pipeline import Pipeline
+from src.Profiler import Profiler
 from src.Replacer import Replacer
+from src.VerdictCache import VerdictCache
+from src.Walker import WalkedDirectory, Walker
 
 """
 Find all the files in the watched directories, check they are eligible for replacement with the Checker.
@@ -23,6 +30,8 @@ class Finder:
         indexer: Indexer,
         checker: Checker,
         replacer: Replacer,
+        metrics: Metrics = None,
+        profiler: Profiler = None,
     ):
         self.config = config
         self.watch_directories = config["directories"]["watch-directories"]
@@ -31,25 +40,55 @@ class Finder:
         self.indexer = indexer
         self.checker = checker
         self.replacer = replacer
+        self.metrics = metrics or Metrics()
+        self.profiler = profiler or Profiler()
 
         self.followlinks = self.config["followlinks"]
+        self.walker = Walker(
+            threads=self.config["walker-threads"],
+            threads_per_root=self.config["walker-threads-per-root"],
+            followlinks=self.followlinks,
+        )
         self.find_candidates_by = self.config["find-candidates-by"]
+        self.candidates_batch_size = self.config["candidates-batch-size"]
+        self.pipeline_config = self.config["pipeline"]
         self.only_undo_symlinks_to_target_directories = self.config[
             "only-undo-symlinks-to-target-directories"
         ]
-
-    def get_candidates(self, file: File) -> list[str]:
-        if self.find_candidates_by == "SIZE":
-            return self.indexer.get_candidates_by_size(file.get_size())
-        if self.find_candidates_by == "FILENAME":
-            return self.indexer.get_candidates_by_filename(file.get_filename())
-        if self.find_candidates_by == "SIZE_OR_FILENAME":
-            return self.indexer.get_candidates_by_size_or_filename(
-                file.get_size(), file.get_filename()
-            )
-
-        return self.indexer.get_candidates_by_size_and_filename(
-            file.get_size(), file.get_filename()
+        self.snapshots = DirectorySnapshots(
+            database,
+            incremental=self.config["incremental"],
+            full_rescan_every_cycles=self.config["full-rescan-every-cycles"],
+            settings=repr(
+                (
+                    checker.min_size,
+                    checker.min_age,
+                    checker.config["exclusions"]["watch-directories-regexes"],
+                    self.find_candidates_by,
+                    self.followlinks,
+                    # The files that couldn't be replaced with other fingerprints must be checked again
+                    checker.fingerprint_sample_size,
+                )
+            ),
+        )
+        self.index_generation = 0  # Of the index used by the last candidates lookup
+        # Too young to be replaced, kept from one cycle to the next until they are old enough,
+        # as their directories are not listed again until then
+        self.young_files: dict[str, File] = {}
+        self.verdicts = VerdictCache(
+            self.config["verdict-cache"],
+            database,
+            indexer,
+            settings=repr(
+                (
+                    self.find_candidates_by,
+                    checker.check_hash,
+                    checker.hash_algorithm,
+                    checker.check_fingerprint,
+                    checker.fingerprint_sample_size,
+                    checker.config["exclusions"]["symlink-target-directories-regexes"],
+                )
+            ),
         )
 
     def find_and_replace_with_symlinks(self) -> None:
@@ -57,74 +96,316 @@ class Finder:
             self.logger.info(
                 f"Finding files to replace with symlinks in directory {directory}"
             )
-            self.find_and_replace_with_symlinks_in_directory(directory["dir"])
-
-    def find_and_replace_with_symlinks_in_directory(self, path: str) -> None:
-        for root, dirs, files in os.walk(path, followlinks=self.followlinks):
-            for filename in files:
-                fullpath = os.path.join(root, filename)
-                # We very obviously want to avoid symlinks!
-                if not os.path.islink(fullpath):
-                    file = File(fullpath)
-                    if (
-                        not self.replacer.is_file_a_replacement(file)
-                    ) and self.checker.is_eligible_for_replacement(file):
-                        candidates = self.get_candidates(file)
-
-                        if len(candidates) > 0:
-                            self.logger.info(
-                                f"Candidates for {fullpath} sorted by priority:\n{"\n".join(candidates)}"
-                            )
-
-                            for candidate in candidates:
-                                try:
-                                    candidate_file = File(candidate)
-                                    if self.checker.can_be_replaced_with(
-                                        file, candidate_file
-                                    ):
-                                        self.logger.info(
-                                            f"Selected candidate {candidate} which matched all criteria, performing replacement"
-                                        )
-                                        self.replacer.replace_with_symlink(
-                                            file, candidate_file
-                                        )
-                                        break  # Do not evaluate other candidates
-                                except Exception as e:
-                                    self.logger.error(
-                                        f"An exception occured while replacing {file.fullpath} with a symlink to {candidate_file.fullpath}: {e}"
-                                    )
-                        else:
-                            self.logger.debug(f"No candidate found for {fullpath}")
+
+        # Directories that didn't change since the last cycle are not listed again
+        self.forget_young_files()
+        self.verdicts.expire()
+        self.snapshots.start_cycle(self.indexer.get_changed_generation())
+        if self.find_and_replace_with_symlinks_in_directories(
+            [directory["dir"] for directory in self.watch_directories],
+            reuse_listing=self.snapshots.reuse_listing,
+        ):
+            self.snapshots.end_cycle()
+
+    def find_and_replace_with_symlinks_in_directories(
+        self,
+        paths: list[str],
+        reuse_listing: Callable[[str, int], list[str] | None] = None,
+    ) -> bool:
+        # Returns whether all the directories have been walked
+        # Eligible files are looked up in batches, with a single query for the whole batch
+        exclusions = self.checker.exclude_watch_directories
+        exclusions.reset_counters()
+
+        # The questions must be asked one at a time, so interactive mode stays serial
+        if self.pipeline_config["enabled"] and not self.replacer.interactive:
+            pipeline = Pipeline(self.pipeline_config, self)
+            pipeline.run(
+                paths,
+                reuse_listing=reuse_listing,
+                prune=exclusions.is_directory_excluded,
+            )
+            self.logger.info(f"Exclusions: {exclusions.get_counters()}")
+            return pipeline.walk_completed
+
+        eligible_files = []
+        for walked in self.walker.walk(
+            paths, reuse_listing=reuse_listing, prune=exclusions.is_directory_excluded
+        ):
+            eligible_files.extend(self.get_eligible_files(walked))
+            if len(eligible_files) >= self.candidates_batch_size:
+                self.replace_with_symlinks(eligible_files)
+                eligible_files = []
+                self.flush(force=False)
+
+        self.replace_with_symlinks(eligible_files)
+        self.flush()
+        self.logger.info(f"Exclusions: {exclusions.get_counters()}")
+        return True
+
+    def get_eligible_files(self, walked: WalkedDirectory) -> list[File]:
+        # Also called from the pipeline eligibility thread, so no database access in here
+        if not walked.listed:
+            self.metrics.increment("directories_walked_total", phase="find", result="unchanged")
+            self.snapshots.skip(walked)
+            return []
+
+        self.metrics.increment("directories_walked_total", phase="find", result="listed")
+        self.metrics.increment(
+            "files_walked_total", len(walked.files), phase="find", directory=walked.root
+        )
+
+        snapshot = self.snapshots.begin(walked)
+        eligible_files = []
+        for entry in walked.files:
+            # We very obviously want to avoid symlinks!
+            file = File.from_dir_entry(entry)
+            try:
+                if file.is_link():
+                    continue
+                if self.is_eligible(file):
+                    self.snapshots.add_file(snapshot, file)
+                    eligible_files.append(file)
+                    continue
+
+                # Files too young to be replaced are checked again once they are old enough,
+                # whatever their size: they might still be written to, without the directory changing
+                revisit_after = file.get_mtime() + self.checker.min_age
+                if revisit_after > time.time():
+                    self.snapshots.revisit(snapshot, revisit_after)
+                    if file.get_size() >= self.checker.min_size:
+                        self.young_files[file.fullpath] = file
+            except OSError as e:
+                self.logger.error(f"Could not stat {file.fullpath}: {e}")
+                self.snapshots.revisit(snapshot, round(time.time()))
+
+        self.snapshots.end_listing(snapshot)
+        return eligible_files
+
+    def forget_young_files(self) -> None:
+        # Forget the files that are old enough now, or gone, the others might have been written to since
+        now = time.time()
+        for fullpath in list(self.young_files):
+            file = File(fullpath)
+            try:
+                if file.is_link() or file.get_mtime() + self.checker.min_age <= now:
+                    del self.young_files[fullpath]
+                else:
+                    self.young_files[fullpath] = file
+            except OSError:
+                del self.young_files[fullpath]
+
+    def find_and_replace_with_symlink(self, file: File) -> None:
+        if self.is_eligible(file):
+            self.replace_with_symlinks([file])
+
+    def is_eligible(self, file: File) -> bool:
+        with self.profiler.span("stat", file=file.fullpath):
+            return (
+                not self.replacer.is_file_a_replacement(file)
+            ) and self.checker.is_eligible_for_replacement(file)
+
+    def flush(self, force: bool = True) -> None:
+        # Write what has been learnt about the watched files so far
+        self.snapshots.flush(force)
+        self.verdicts.flush()
+
+    def find_candidates(self, files: list[File]) -> Iterator[tuple[File, list[File]]]:
+        files_without_candidates = {file.fullpath: file for file in files}
+        with self.profiler.span("lookup", files=len(files)):
+            # Don't look up again the files that would end up the same way as last time
+            unchanged = self.verdicts.get_unchanged(files, self.find_candidates_by)
+            self.index_generation = self.indexer.get_generation()
+            files_to_look_up = [file for file in files if file.fullpath not in unchanged]
+            if self.find_candidates_by == "HASH":
+                results = self.get_candidates_by_hash(files_to_look_up)
+            else:
+                results = list(
+                    self.indexer.get_candidates(
+                        files_to_look_up, self.find_candidates_by
+                    )
+                )
+
+        self.metrics.increment(
+            "verdict_cache_lookups_total", len(unchanged), result="hit"
+        )
+        self.metrics.increment(
+            "verdict_cache_lookups_total", len(files) - len(unchanged), result="miss"
+        )
+        for fullpath in unchanged:
+            self.logger.debug(
+                f"Not looking up {fullpath} again, neither it nor its possible candidates changed since last time"
+            )
+            self.snapshots.file_done(
+                files_without_candidates.pop(fullpath), replaced=False
+            )
+
+        for fullpath, candidates in results:
+            file = files_without_candidates.pop(fullpath)
+            self.logger.info(
+                f"Candidates for {fullpath} sorted by priority:\n{"\n".join(candidates)}"
+            )
+            yield (file, [File(candidate) for candidate in candidates])
+
+        for fullpath, file in files_without_candidates.items():
+            self.logger.debug(f"No candidate found for {fullpath}")
+            self.verdicts.record(
+                file, VerdictCache.NO_CANDIDATE, self.index_generation
+            )
+            self.snapshots.file_done(file, replaced=False)
+
+    def get_candidates_by_hash(
+        self, files: list[File]
+    ) -> list[tuple[str, list[str]]]:
+        # Only the files with candidates of the same size are hashed (they are local, so that's cheap),
+        # then the target files with the same hash in the cache are the only candidates
+        # The candidates of the files without any are the ones of the same size, they might not have been hashed yet
+        results = list(self.indexer.get_candidates(files, "SIZE"))
+        files_with_candidates = {file.fullpath: file for file in files}
+        files_with_candidates = [
+            files_with_candidates[fullpath] for fullpath, _ in results
+        ]
+
+        try:
+            hashes = self.checker.get_hashes(files_with_candidates)
+        except Exception as e:
+            # Those that could be hashed are in the cache, the others will be reported when checking them
+            self.logger.debug(f"An exception occured while hashing the files to look up: {e}")
+            hashes = self.checker.get_cached_hashes(files_with_candidates)
+
+        matches = dict(
+            self.indexer.get_candidates(
+                files_with_candidates,
+                "HASH",
+                {
+                    file.fullpath: (
+                        self.checker.get_algorithm(file),
+                        hashes[file.fullpath],
+                    )
+                    for file in files_with_candidates
+                    if file.fullpath in hashes
+                },
+            )
+        )
+        self.metrics.increment("hash_lookups_total", len(matches), result="match")
+        self.metrics.increment(
+            "hash_lookups_total", len(results) - len(matches), result="no_match"
+        )
+        return [
+            (fullpath, matches.get(fullpath, candidates))
+            for fullpath, candidates in results
+        ]
+
+    def replace_with_symlinks(self, files: list[File]) -> None:
+        # Files with candidates are processed in batches, so their hashes can be computed concurrently
+        pending = []
+        for file_with_candidates in self.find_candidates(files):
+            pending.append(file_with_candidates)
+            if len(pending) >= self.checker.hashing_batch_size:
+                self.verify_and_replace_with_symlinks(pending)
+                pending = []
+
+        self.verify_and_replace_with_symlinks(pending)
+
+    def verify_and_replace_with_symlinks(
+        self, pending: list[tuple[File, list[File]]]
+    ) -> None:
+        if len(pending) == 0:
+            return
+
+        # Candidates known to match are checked first, so the others don't have to be read
+        if self.checker.check_hash:
+            cached_hashes = [
+                self.checker.get_cached_hashes(candidates) for _, candidates in pending
+            ]
+            try:
+                # The originals needed to sort them are hashed concurrently
+                self.checker.get_hashes(
+                    [
+                        file
+                        for (file, _), hashes in zip(pending, cached_hashes)
+                        if len(hashes) > 0
+                    ]
+                )
+            except Exception as e:
+                # Will be raised again, and properly reported, when checking that file
+                self.logger.debug(f"An exception occured while hashing the files to sort their candidates: {e}")
+            pending = [
+                (file, self.checker.order_candidates(file, candidates, hashes))
+                for (file, candidates), hashes in zip(pending, cached_hashes)
+            ]
+
+        self.checker.prefetch(pending)
+
+        for file, candidates in pending:
+            replaced = False
+            failed = False
+            for candidate_file in candidates:
+                try:
+                    if self.checker.can_be_replaced_with(file, candidate_file):
+                        self.logger.info(
+                            f"Selected candidate {candidate_file.fullpath} which matched all criteria, performing replacement"
+                        )
+                        with self.profiler.span("replace", file=file.fullpath):
+                            self.replacer.replace_with_symlink(file, candidate_file)
+                        replaced = True
+                        break  # Do not evaluate other candidates
+                except Exception as e:
+                    failed = True
+                    self.logger.error(
+                        f"An exception occured while replacing {file.fullpath} with a symlink to {candidate_file.fullpath}: {e}"
+                    )
+
+            # Errors might not happen next time, so only remember actual mismatches
+            if not replaced and not failed:
+                self.verdicts.record(
+                    file, VerdictCache.ALL_MISMATCHED, self.index_generation
+                )
+            # A dry run doesn't replace anything, the file must be found again next time, as after errors
+            self.snapshots.file_done(
+                file,
+                replaced and not self.replacer.dry_run,
+                retry=failed or (replaced and self.replacer.dry_run),
+            )
 
     def find_and_replace_with_content(self) -> None:
         for directory in self.undo_directories:
             self.logger.info(
                 f"Finding files to replace with content in directory {directory}"
             )
-            self.find_and_replace_with_content_in_directory(directory["dir"])
+        self.find_and_replace_with_content_in_directories(
+            [directory["dir"] for directory in self.undo_directories]
+        )
 
-    def find_and_replace_with_content_in_directory(self, path: str) -> None:
-        for root, dirs, files in os.walk(path, followlinks=self.followlinks):
-            for filename in files:
-                fullpath = os.path.join(root, filename)
+    def find_and_replace_with_content_in_directories(self, paths: list[str]) -> None:
+        exclusions = self.checker.exclude_undo_symlinks_directories
+        exclusions.reset_counters()
+        for walked in self.walker.walk(paths, prune=exclusions.is_directory_excluded):
+            self.metrics.increment(
+                "files_walked_total", len(walked.files), phase="undo", directory=walked.root
+            )
+            for entry in walked.files:
                 # We are only interested in symlinks over here!
-                if os.path.islink(fullpath):
-                    symlink_file = File(fullpath)
-                    link_target = symlink_file.get_readlink()
-                    if (
-                        not self.only_undo_symlinks_to_target_directories
-                        or self.indexer.is_file_within_target_directories(link_target)
-                    ):
-                        if self.checker.is_eligible_for_content_replacement(
-                            symlink_file
-                        ):
-                            self.logger.info(
-                                f"Found a simlink to unwind: {fullpath} which links to {link_target}"
-                            )
-
-                            try:
-                                self.replacer.replace_with_content(symlink_file)
-                            except Exception as e:
-                                self.logger.error(
-                                    f"An exception occured while replacing {symlink_file.fullpath} with contents from {link_target}: {e}"
-                                )
+                symlink_file = File.from_dir_entry(entry)
+                if symlink_file.is_link():
+                    self.find_and_replace_symlink_with_content(symlink_file)
+        self.logger.info(f"Exclusions: {exclusions.get_counters()}")
+
+    def find_and_replace_symlink_with_content(self, symlink_file: File) -> None:
+        link_target = symlink_file.get_readlink()
+        if (
+            not self.only_undo_symlinks_to_target_directories
+            or self.indexer.is_file_within_target_directories(link_target)
+        ):
+            if self.checker.is_eligible_for_content_replacement(symlink_file):
+                self.logger.info(
+                    f"Found a simlink to unwind: {symlink_file.fullpath} which links to {link_target}"
+                )
+
+                try:
+                    with self.profiler.span("replace", file=symlink_file.fullpath):
+                        self.replacer.replace_with_content(symlink_file)
+                except Exception as e:
+                    self.logger.error(
+                        f"An exception occured while replacing {symlink_file.fullpath} with contents from {link_target}: {e}"
+                    )
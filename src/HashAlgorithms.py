@@ -0,0 +1,82 @@
+import hashlib
+import logging
+import os
+import time
+from typing import Callable
+
+# Optional, faster, non cryptographic hashes, only available if installed
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+"""
+Registry of the hash algorithms that can be used to compare files.
+"""
+
+
+class HashAlgorithms:
+    logger = logging.getLogger("HashAlgorithms")
+
+    algorithms: dict[str, Callable] = {
+        "md5": hashlib.md5,
+        "sha1": hashlib.sha1,
+        "sha256": hashlib.sha256,
+        "blake2b": hashlib.blake2b,
+    }
+    if xxhash is not None:
+        algorithms["xxh64"] = xxhash.xxh64
+        algorithms["xxh3_128"] = xxhash.xxh3_128
+    if blake3 is not None:
+        algorithms["blake3"] = blake3.blake3
+
+    @classmethod
+    def get_available(cls) -> list[str]:
+        return list(cls.algorithms.keys())
+
+    @classmethod
+    def check(cls, name: str) -> None:
+        if name not in cls.algorithms:
+            raise Exception(
+                f"Unknown or unavailable hash algorithm '{name}', available ones are: {', '.join(cls.get_available())}"
+            )
+
+    @classmethod
+    def new(cls, name: str):
+        cls.check(name)
+        return cls.algorithms[name]()
+
+    @classmethod
+    def benchmark(
+        cls, buffer_size: int = 2**20, duration_seconds: float = 2
+    ) -> dict[str, float]:
+        # Hash the same random buffer for a while with each algorithm, and report the speed in MB/s
+        buffer = os.urandom(buffer_size)
+        speeds = {}
+        for name in cls.get_available():
+            m = cls.new(name)
+            hashed_bytes = 0
+            start_time = time.perf_counter()
+            while time.perf_counter() - start_time < duration_seconds:
+                m.update(buffer)
+                hashed_bytes += buffer_size
+            m.hexdigest()
+            speeds[name] = hashed_bytes / (time.perf_counter() - start_time) / 10**6
+        return speeds
+
+    @classmethod
+    def print_benchmark(cls) -> None:
+        if xxhash is None:
+            cls.logger.info("xxhash is not installed, install it to benchmark xxh64 and xxh3_128")
+        if blake3 is None:
+            cls.logger.info("blake3 is not installed, install it to benchmark blake3")
+
+        cls.logger.info("Benchmarking the hash algorithms, this will take a few seconds")
+        speeds = cls.benchmark()
+        for name, speed in sorted(speeds.items(), key=lambda s: s[1], reverse=True):
+            cls.logger.info(f"{name:>10}: {round(speed)} MB/s")
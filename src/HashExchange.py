@@ -0,0 +1,185 @@
+import gzip
+import json
+import logging
+import os
+import sqlite3
+
+"""
+Share the hashes of the files in the target directories between several instances mounting the same remote,
+so each file only has to be read once over the network.
+Exports are gzipped JSON lines: a header with the names of the target directories, then one
+[directory, path, size, mtime, algorithm, hash, fingerprint] per file, with the index of its target directory
+in the configuration and the path relative to it, so it doesn't matter where the remote is mounted.
+"""
+
+
+class HashExchange:
+    logger = logging.getLogger("HashExchange")
+
+    format: str = "symlinkerr-hashes"
+    version: int = 2
+
+    def __init__(
+        self,
+        database: sqlite3.Connection,
+        target_directories: list[dict],
+        fingerprint_sample_size: int,
+    ):
+        self.database = database
+        # In the order of the configuration, which is how the directories are identified in the exports
+        self.configured_directories = [d["dir"].rstrip(os.sep) for d in target_directories]
+        # Deepest directories first, so they win over their parents
+        self.target_directories = sorted(
+            [d["dir"].rstrip(os.sep) for d in target_directories],
+            key=len,
+            reverse=True,
+        )
+        # Fingerprints taken with a different sample size can't be compared
+        self.fingerprint_sample_size = fingerprint_sample_size
+
+    def get_target_directory(self, fullpath: str) -> str | None:
+        for directory in self.target_directories:
+            if fullpath.startswith(directory + os.sep):
+                return directory
+        return None
+
+    def export_hashes(self, path: str) -> None:
+        exported = 0
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "format": self.format,
+                        "version": self.version,
+                        "fingerprint-sample-bytes": self.fingerprint_sample_size,
+                        "directories": [
+                            os.path.basename(d) for d in self.configured_directories
+                        ],
+                    }
+                )
+                + "\n"
+            )
+
+            for directory in self.target_directories:
+                index = self.configured_directories.index(directory)
+                # Only export the rows of the deepest target directory containing them
+                for fullpath, size, mtime, algorithm, digest, fingerprint in self.database.execute(
+                    "SELECT fullpath, size, mtime, algorithm, hash, fingerprint FROM hashes WHERE fullpath>? AND fullpath<?",
+                    (directory + os.sep, directory + chr(ord(os.sep) + 1)),
+                ):
+                    if self.get_target_directory(fullpath) != directory:
+                        continue
+
+                    f.write(
+                        json.dumps(
+                            [
+                                index,
+                                os.path.relpath(fullpath, directory),
+                                size,
+                                mtime,
+                                algorithm,
+                                digest,
+                                fingerprint,
+                            ]
+                        )
+                        + "\n"
+                    )
+                    exported += 1
+
+        self.logger.info(f"Exported {exported} hashes to {path}")
+
+    def get_directories(self, names: list[str]) -> dict[int, str]:
+        # Maps the indexes of the exported target directories to ours, as they might be mounted elsewhere on this host
+        # The same position with the same name, or else the only remaining one of ours with that name,
+        # if it's also the only remaining exported one with that name
+        directories = {
+            index: self.configured_directories[index]
+            for index, name in enumerate(names)
+            if index < len(self.configured_directories)
+            and os.path.basename(self.configured_directories[index]) == name
+        }
+        remaining = [
+            d for d in self.configured_directories if d not in directories.values()
+        ]
+        remaining_names = [
+            name for index, name in enumerate(names) if index not in directories
+        ]
+        for index, name in enumerate(names):
+            if index in directories:
+                continue
+            same_name = [d for d in remaining if os.path.basename(d) == name]
+            if len(same_name) == 1 and remaining_names.count(name) == 1:
+                directories[index] = same_name[0]
+            else:
+                self.logger.warning(
+                    f"Ignoring the hashes of {name}, which is not the name of a single target directory here"
+                )
+        return directories
+
+    def import_hashes(self, path: str) -> None:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline() or "{}")
+            if header.get("format") != self.format or header.get("version") != self.version:
+                raise Exception(f"{path} is not an export of the hashes of a compatible version")
+            directories = self.get_directories(header["directories"])
+            same_fingerprints = (
+                header["fingerprint-sample-bytes"] == self.fingerprint_sample_size
+            )
+            if not same_fingerprints:
+                self.logger.warning(
+                    f"The fingerprints of {path} have been taken with samples of {header['fingerprint-sample-bytes']} bytes instead of {self.fingerprint_sample_size}, ignoring them"
+                )
+
+            rows = []
+            for line in f:
+                index, relative_path, size, mtime, algorithm, digest, fingerprint = json.loads(line)
+                if index not in directories:
+                    continue
+
+                rows.append(
+                    (
+                        os.path.join(directories[index], relative_path),
+                        algorithm,
+                        digest,
+                        size,
+                        mtime,
+                        fingerprint if same_fingerprints else None,
+                    )
+                )
+
+        # The most recent version of the file wins, what we know locally wins when both are the same age
+        # The device and inode of another host are meaningless here
+        before = self.database.total_changes
+        self.database.executemany(
+            """
+            INSERT INTO hashes(fullpath, algorithm, hash, size, mtime, fingerprint, source) VALUES(?, ?, ?, ?, ?, ?, 'imported')
+            ON CONFLICT(fullpath, algorithm) DO UPDATE SET
+                hash=CASE
+                    WHEN hashes.mtime<excluded.mtime OR hashes.hash IS NULL THEN excluded.hash
+                    ELSE hashes.hash
+                END,
+                source=CASE
+                    WHEN hashes.mtime<excluded.mtime OR hashes.hash IS NULL THEN excluded.source
+                    ELSE hashes.source
+                END,
+                fingerprint=CASE
+                    WHEN hashes.mtime<excluded.mtime OR hashes.fingerprint IS NULL THEN excluded.fingerprint
+                    ELSE hashes.fingerprint
+                END,
+                device=CASE WHEN hashes.mtime<excluded.mtime THEN NULL ELSE hashes.device END,
+                inode=CASE WHEN hashes.mtime<excluded.mtime THEN NULL ELSE hashes.inode END,
+                size=CASE WHEN hashes.mtime<excluded.mtime THEN excluded.size ELSE hashes.size END,
+                mtime=MAX(hashes.mtime, excluded.mtime)
+            WHERE hashes.mtime<excluded.mtime
+                OR (hashes.size=excluded.size AND hashes.mtime=excluded.mtime AND (
+                    (hashes.hash IS NULL AND excluded.hash IS NOT NULL)
+                    OR (hashes.fingerprint IS NULL AND excluded.fingerprint IS NOT NULL)
+                ))
+            """,
+            rows,
+        )
+        self.database.commit()
+
+        self.logger.info(
+            f"Imported {self.database.total_changes - before} of the {len(rows)} hashes of {path}"
+        )
@@ -0,0 +1,62 @@
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from src.File import File
+
+"""
+Run the hash computations in threads, with a limit of concurrent computations per device/mount.
+This way local disks and remote mounts are busy at the same time, without flooding the remote ones.
+"""
+
+
+class HashExecutor:
+    logger = logging.getLogger("HashExecutor")
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.threads_per_device = config["threads-per-device"]
+
+        # Deepest mounts first, so they win over their parents
+        self.mounts = sorted(
+            config["mounts"], key=lambda m: len(m["dir"]), reverse=True
+        )
+
+        self.executors: dict[str, ThreadPoolExecutor] = {}
+        self.lock = threading.Lock()
+
+    def get_device(self, file: File) -> str:
+        for mount in self.mounts:
+            directory = mount["dir"].rstrip(os.sep)
+            if file.fullpath == directory or file.fullpath.startswith(
+                directory + os.sep
+            ):
+                return mount["dir"]
+        return f"device:{file.get_device()}"
+
+    def get_threads(self, device: str) -> int:
+        for mount in self.mounts:
+            if mount["dir"] == device:
+                return mount["threads"]
+        return self.threads_per_device
+
+    def get_executor(self, device: str) -> ThreadPoolExecutor:
+        with self.lock:
+            if device not in self.executors:
+                threads = max(1, self.get_threads(device))
+                self.logger.debug(f"Hashing up to {threads} files at once on {device}")
+                self.executors[device] = ThreadPoolExecutor(
+                    max_workers=threads, thread_name_prefix="HashExecutor"
+                )
+            return self.executors[device]
+
+    def submit(self, file: File, compute: Callable[[File], str]) -> Future:
+        return self.get_executor(self.get_device(file)).submit(compute, file)
+
+    def shutdown(self) -> None:
+        with self.lock:
+            for executor in self.executors.values():
+                executor.shutdown(wait=False, cancel_futures=True)
+            self.executors = {}
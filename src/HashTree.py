@@ -0,0 +1,130 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from src.HashAlgorithms import HashAlgorithms
+from src.IoScheduler import IoLimiter
+
+"""
+Hash large files as a list of fixed-size chunks, and a root hash of that list.
+The chunks are independent, so several threads can read a single file at different offsets,
+and a copy can be checked chunk by chunk against the list we know, failing at the first corrupted one.
+Root hashes are stored under their own algorithm name (eg. xxh128-tree-67108864), so they are never compared with plain hashes.
+"""
+
+
+class CorruptedChunkError(Exception):
+    def __init__(self, index: int, offset: int, expected: str, actual: str):
+        super().__init__(
+            f"Chunk {index} (at {offset} bytes) has the hash {actual} but we were expecting {expected}"
+        )
+        self.index = index
+        self.offset = offset
+
+
+class HashTree:
+    logger = logging.getLogger("HashTree")
+
+    blocksize: int = 2**20
+
+    def __init__(self, hash_algorithm: str, chunk_size: int, threads: int = 4):
+        self.hash_algorithm = hash_algorithm
+        self.chunk_size = max(self.blocksize, chunk_size)
+        self.threads = max(1, threads)
+        self.algorithm = f"{hash_algorithm}-tree-{self.chunk_size}"
+
+    def get_root(self, size: int, chunks: list[str]) -> str:
+        m = HashAlgorithms.new(self.hash_algorithm)
+        m.update(f"{size}:{self.chunk_size}".encode())
+        for chunk in chunks:
+            m.update(bytes.fromhex(chunk))
+        return m.hexdigest()
+
+    def compute(
+        self,
+        fullpath: str,
+        size: int,
+        limiter: IoLimiter | None = None,
+        stop: threading.Event = None,
+    ) -> list[str]:
+        # Returns the hashes of the chunks, read concurrently with pread
+        # Setting stop interrupts the computation (with an exception) before reading the next block
+        count = max(1, -(-size // self.chunk_size))
+        failed = threading.Event()
+
+        def hash_chunk(index: int) -> str:
+            m = HashAlgorithms.new(self.hash_algorithm)
+            offset = index * self.chunk_size
+            end = min(size, offset + self.chunk_size)
+            try:
+                while offset < end:
+                    if failed.is_set() or (stop is not None and stop.is_set()):
+                        raise Exception(f"Hashing of {fullpath} interrupted")
+                    buf = os.pread(fd, min(self.blocksize, end - offset), offset)
+                    if not buf:
+                        raise Exception(f"{fullpath} is shorter than {size} bytes")
+                    if limiter is not None:
+                        limiter.read(len(buf))
+                    m.update(buf)
+                    offset += len(buf)
+            except Exception:
+                failed.set()  # No need to finish the other chunks
+                raise
+            return m.hexdigest()
+
+        if limiter is not None:
+            limiter.opened()
+        with open(fullpath, "rb", buffering=0) as f:
+            fd = f.fileno()
+            with ThreadPoolExecutor(
+                max_workers=min(self.threads, count), thread_name_prefix="HashTree"
+            ) as executor:
+                return list(executor.map(hash_chunk, range(count)))
+
+    def new_hasher(self, expected_chunks: list[str] | None = None) -> "TreeHasher":
+        return TreeHasher(self, expected_chunks)
+
+
+class TreeHasher:
+    # Same interface as the hashlib objects, for the content read sequentially (eg. while copying)
+    # Raises a CorruptedChunkError as soon as a chunk differs from the expected ones, if any
+
+    def __init__(self, tree: HashTree, expected_chunks: list[str] | None = None):
+        self.tree = tree
+        self.expected_chunks = expected_chunks
+        self.chunks: list[str] = []
+        self.size = 0
+        self.current = HashAlgorithms.new(tree.hash_algorithm)
+        self.current_size = 0
+
+    def update(self, data) -> None:
+        view = memoryview(data)
+        while len(view) > 0:
+            length = min(len(view), self.tree.chunk_size - self.current_size)
+            self.current.update(view[:length])
+            self.current_size += length
+            self.size += length
+            view = view[length:]
+            if self.current_size == self.tree.chunk_size:
+                self.end_chunk()
+
+    def end_chunk(self) -> None:
+        index = len(self.chunks)
+        chunk = self.current.hexdigest()
+        if (
+            self.expected_chunks is not None
+            and index < len(self.expected_chunks)
+            and chunk != self.expected_chunks[index]
+        ):
+            raise CorruptedChunkError(
+                index, index * self.tree.chunk_size, self.expected_chunks[index], chunk
+            )
+        self.chunks.append(chunk)
+        self.current = HashAlgorithms.new(self.tree.hash_algorithm)
+        self.current_size = 0
+
+    def hexdigest(self) -> str:
+        if self.current_size > 0 or len(self.chunks) == 0:
+            self.end_chunk()
+        return self.tree.get_root(self.size, self.chunks)
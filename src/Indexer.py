@@ -1,9 +1,13 @@
+import collections
 import logging
 import os
 import sqlite3
+from typing import Iterator
 
+from src.Exclusions import Exclusions
 from src.File import File
-
+from src.Metrics import Metrics
+from src.Walker import Walker
 
 """
 Find all the files in the target directories and put them into the database.
@@ -13,32 +17,69 @@ Find all the files in the target directories and put them into the database.
 class Indexer:
     logger = logging.getLogger("Indexer")
 
+    commit_every: int = 10000
+
     def __init__(
         self,
         config: dict,
         target_directories: list[str],
         database: sqlite3.Connection,
         min_size: int = 0,
+        exclusions: list[str] = [],
+        metrics: Metrics = None,
     ):
         self.config = config
         self.target_directories = target_directories
         self.database = database
         self.min_size = min_size
+        self.exclusions_regexes = exclusions
+        self.exclusions = Exclusions(exclusions)
+        self.metrics = metrics or Metrics()
 
         self.followlinks = self.config["followlinks"]
+        self.incremental = self.config["incremental"]
+        self.full_rescan_every_generations = self.config[
+            "full-rescan-every-generations"
+        ]
+
+        self.create_index_tables()
+
+    def create_index_tables(self) -> None:
+        # The index used to be dropped and rebuilt on every run, there is nothing worth migrating
+        columns = [
+            c[1]
+            for c in self.database.execute(
+                "PRAGMA table_info(index_target_directories);"
+            ).fetchall()
+        ]
+        if len(columns) > 0 and "generation" not in columns:
+            self.database.execute("DROP TABLE IF EXISTS index_target_directories;")
 
-    def index_target_directories(self) -> None:
-        # Recreate the indexing table
-        self.database.execute("DROP TABLE IF EXISTS index_target_directories;")
         self.database.execute("""
-            CREATE TABLE index_target_directories (
+            CREATE TABLE IF NOT EXISTS index_target_directories (
                 fullpath VARCHAR PRIMARY KEY,
                 filename VARCHAR,
                 size LONG,
-                priority INTEGER
+                mtime LONG,
+                priority INTEGER,
+                directory VARCHAR,
+                generation INTEGER,
+                changed_generation INTEGER
             );
         """)
 
+        # Generation in which the file was added or last changed, so past results can be reused until then
+        columns = [
+            c[1]
+            for c in self.database.execute(
+                "PRAGMA table_info(index_target_directories);"
+            ).fetchall()
+        ]
+        if "changed_generation" not in columns:
+            self.database.execute(
+                "ALTER TABLE index_target_directories ADD COLUMN changed_generation INTEGER DEFAULT 0;"
+            )
+
         self.database.execute("""
             CREATE INDEX IF NOT EXISTS index_target_directories__filename
             ON index_target_directories(filename)
@@ -47,66 +88,385 @@ class Indexer:
             CREATE INDEX IF NOT EXISTS index_target_directories__size
             ON index_target_directories(size)
         """)
+        self.database.execute("""
+            CREATE INDEX IF NOT EXISTS index_target_directories__directory
+            ON index_target_directories(directory)
+        """)
+
+        # Directories seen while indexing, with their mtime when they were last listed
+        self.database.execute("""
+            CREATE TABLE IF NOT EXISTS index_target_directories_dirs (
+                directory VARCHAR PRIMARY KEY,
+                parent VARCHAR,
+                mtime LONG,
+                priority INTEGER,
+                generation INTEGER
+            );
+        """)
+        self.database.execute("""
+            CREATE INDEX IF NOT EXISTS index_target_directories_dirs__parent
+            ON index_target_directories_dirs(parent)
+        """)
+
+        self.database.execute("""
+            CREATE TABLE IF NOT EXISTS indexer_state (
+                key VARCHAR PRIMARY KEY,
+                value VARCHAR
+            );
+        """)
+        self.database.commit()
+
+    def get_state(self, key: str) -> str | None:
+        row = self.database.execute(
+            "SELECT value FROM indexer_state WHERE key=?", (key,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def set_state(self, key: str, value: str) -> None:
+        self.database.execute(
+            "INSERT OR REPLACE INTO indexer_state(key, value) VALUES(?, ?)",
+            (key, value),
+        )
+
+    def get_generation(self) -> int:
+        return int(self.get_state("generation") or 0)
+
+    def get_changed_generation(self) -> int:
+        # Last generation in which files were added, changed or removed
+        return int(self.get_state("changed-generation") or 0)
+
+    def index_target_directories(self) -> None:
+        # The table is updated in place, so lookups can keep running while we index
+        self.create_index_tables()
+
+        generation = self.get_generation() + 1
+        self.set_state("generation", str(generation))
+
+        full_rescan = not self.incremental
+        if (
+            self.full_rescan_every_generations > 0
+            and generation % self.full_rescan_every_generations == 0
+        ):
+            full_rescan = True
+
+        # Changing those settings changes what ends up in the index, so we can't trust the previous scans
+        settings = repr((self.min_size, self.followlinks, self.exclusions_regexes))
+        if self.get_state("settings") != settings:
+            self.set_state("settings", settings)
+            full_rescan = True
+
+        if full_rescan:
+            self.logger.info("Performing a full rescan of the target directories")
 
         for directory in self.target_directories:
             self.logger.info(f"Indexing target directory {directory}")
-            self.index_directory(directory["dir"], directory["priority"])
+        written_files = self.index_directories(
+            self.target_directories, generation, full_rescan
+        )
 
+        # Everything that hasn't been seen during this generation is gone
+        deleted_files = self.database.execute(
+            "DELETE FROM index_target_directories WHERE generation<?", (generation,)
+        ).rowcount
+        deleted_directories = self.database.execute(
+            "DELETE FROM index_target_directories_dirs WHERE generation<?",
+            (generation,),
+        ).rowcount
+        if written_files > 0 or deleted_files > 0:
+            self.set_state("changed-generation", str(generation))
         self.database.commit()
 
-    def index_directory(self, path: str, priority: int) -> None:
-        for root, dirs, files in os.walk(path, followlinks=self.followlinks):
-            for filename in files:
-                fullpath = os.path.join(root, filename)
-                file = File(fullpath)
-                if file.get_size() >= self.min_size:
-                    self.logger.debug(
-                        f"Found file with size {file.get_size()}: {fullpath}"
-                    )
-                    self.database.execute(
-                        "INSERT OR IGNORE INTO index_target_directories(fullpath, filename, size, priority) VALUES(?, ?, ?, ?)",
-                        (fullpath, filename, file.get_size(), priority),
-                    )
-                else:
-                    self.logger.debug(
-                        f"Ignoring file with size {file.get_size()}: {fullpath} as it's lower than the minimum threshold of {self.min_size}"
-                    )
-
-    def get_candidates_by_size_and_filename(
-        self, size: int, filename: str
-    ) -> list[str]:
-        return self.fetch_to_array(
+        self.metrics.set(
+            "index_rows",
             self.database.execute(
-                f"SELECT fullpath FROM index_target_directories WHERE size={size} AND filename=? ORDER BY priority",
-                (filename,),
-            )
+                "SELECT COUNT(*) FROM index_target_directories"
+            ).fetchone()[0],
         )
+        self.metrics.increment("index_rows_deleted_total", deleted_files)
 
-    def get_candidates_by_size_or_filename(self, size: int, filename: str) -> list[str]:
-        return self.fetch_to_array(
-            self.database.execute(
-                f"SELECT fullpath FROM index_target_directories WHERE size={size} OR filename=? ORDER BY priority",
-                (filename,),
-            )
+        self.logger.info(
+            f"Indexing generation {generation} done, removed {deleted_files} files and {deleted_directories} directories which are not there anymore"
         )
 
-    def get_candidates_by_size(self, size: int) -> list[str]:
-        return self.fetch_to_array(
+    def index_directories(
+        self, directories: list[dict], generation: int, full_rescan: bool = True
+    ) -> int:
+        # Returns the number of files (re)written from the directories that had to be listed
+        # Target directories are walked concurrently, so make sure each file is only indexed from
+        # the target directory with the highest priority (ie. the lowest), like if they were walked in order
+        roots = []
+        priorities = {}
+        shadowed_by = {}
+        for i, directory in enumerate(directories):
+            ranking = (directory["priority"], i)
+            better = [
+                d["dir"]
+                for j, d in enumerate(directories)
+                if (d["priority"], j) < ranking
+            ]
+            if any(self.is_within(directory["dir"], b) for b in better):
+                self.logger.info(
+                    f"Not indexing {directory['dir']} on its own, it's within a target directory with a higher priority"
+                )
+                continue
+
+            roots.append(directory["dir"])
+            priorities[directory["dir"]] = directory["priority"]
+            shadowed_by[directory["dir"]] = set(b.rstrip(os.sep) for b in better)
+
+        known_directories = {}
+        known_subdirectories = collections.defaultdict(list)
+        if not full_rescan:
+            for directory, parent, mtime, priority in self.database.execute(
+                "SELECT directory, parent, mtime, priority FROM index_target_directories_dirs"
+            ).fetchall():
+                known_directories[directory] = (mtime, priority)
+                known_subdirectories[parent].append(directory)
+
+        def reuse_listing(path: str, mtime: int) -> list[str] | None:
+            # Nothing was added, removed or renamed in there, no need to list it again
+            if known_directories.get(path) == (mtime, priorities.get(self.get_root(path, roots))):
+                return known_subdirectories[path]
+            return None
+
+        def prune(path: str) -> bool:
+            # Excluded directories are never listed
+            if self.exclusions.is_directory_excluded(path):
+                return True
+            # Higher priority target directories nested in this one are indexed on their own
+            return path in shadowed_by[self.get_root(path, roots)]
+
+        failed_directories = []
+
+        def on_error(path: str, parent: str | None) -> None:
+            failed_directories.append((path, parent))
+
+        walker = Walker(
+            threads=self.config["walker-threads"],
+            threads_per_root=self.config["walker-threads-per-root"],
+            followlinks=self.followlinks,
+        )
+
+        self.exclusions.reset_counters()
+        listed_directories = 0
+        unchanged_directories = 0
+        written_files = 0
+        pending_writes = 0
+        for walked in walker.walk(
+            roots, reuse_listing=reuse_listing, prune=prune, on_error=on_error
+        ):
+            priority = priorities[walked.root]
+
+            if walked.listed:
+                listed_directories += 1
+                self.metrics.increment(
+                    "files_walked_total",
+                    len(walked.files),
+                    phase="index",
+                    directory=walked.root,
+                )
+                for entry in walked.files:
+                    written = self.index_entry(entry, walked.path, priority, generation)
+                    written_files += written
+                    pending_writes += written
+            else:
+                unchanged_directories += 1
+                pending_writes += self.database.execute(
+                    "UPDATE index_target_directories SET generation=? WHERE directory=? AND generation<?",
+                    (generation, walked.path, generation),
+                ).rowcount
+
             self.database.execute(
-                f"SELECT fullpath FROM index_target_directories WHERE size={size} ORDER BY priority"
+                """
+                INSERT INTO index_target_directories_dirs(directory, parent, mtime, priority, generation) VALUES(?, ?, ?, ?, ?)
+                ON CONFLICT(directory) DO UPDATE SET
+                    parent=excluded.parent, mtime=excluded.mtime, priority=excluded.priority, generation=excluded.generation
+                """,
+                (walked.path, walked.parent, walked.mtime, priority, generation),
             )
+
+            # Commit regularly to avoid holding a write lock for the whole indexing
+            if pending_writes >= self.commit_every:
+                self.database.commit()
+                pending_writes = 0
+
+        for path, parent in failed_directories:
+            self.keep_directory(path, parent, generation)
+
+        self.database.commit()
+        self.logger.info(
+            f"Indexing done: listed {listed_directories} directories, skipped {unchanged_directories} unchanged directories"
         )
+        self.logger.info(f"Exclusions: {self.exclusions.get_counters()}")
+        return written_files
 
-    def get_candidates_by_filename(self, filename: str) -> list[str]:
-        return self.fetch_to_array(
+    def keep_directory(self, path: str, parent: str | None, generation: int) -> None:
+        # A directory that couldn't be listed (eg. a remote mount error) is probably still there:
+        # keep what we know about it and its subdirectories instead of removing them from the index,
+        # and list its parent again next time, as it might not know about that directory yet
+        self.logger.warning(
+            f"Keeping the files of {path} from the previous indexing, it will be listed again next time"
+        )
+        subtree = (generation, path, path + os.sep, path + chr(ord(os.sep) + 1))
+        self.database.execute(
+            "UPDATE index_target_directories SET generation=? WHERE directory=? OR (directory>? AND directory<?)",
+            subtree,
+        )
+        self.database.execute(
+            "UPDATE index_target_directories_dirs SET generation=? WHERE directory=? OR (directory>? AND directory<?)",
+            subtree,
+        )
+        if parent is not None:
             self.database.execute(
-                "SELECT fullpath FROM index_target_directories WHERE filename=? ORDER BY priority",
-                (filename,),
+                "UPDATE index_target_directories_dirs SET mtime=NULL WHERE directory=?",
+                (parent,),
+            )
+
+    def index_entry(
+        self, entry: os.DirEntry, directory: str, priority: int, generation: int
+    ) -> int:
+        if self.exclusions.is_file_excluded(entry.path):
+            return 0
+
+        try:
+            file = File.from_dir_entry(entry)
+            # Follow symlinks, we want the size of what they are pointing to
+            size = file.get_size()
+        except OSError as e:
+            self.logger.error(f"Could not stat {entry.path}: {e}")
+            return 0
+
+        if size < self.min_size:
+            self.logger.debug(
+                f"Ignoring file with size {size}: {entry.path} as it's lower than the minimum threshold of {self.min_size}"
             )
+            return 0
+
+        self.logger.debug(f"Found file with size {size}: {entry.path}")
+        self.metrics.increment("index_rows_written_total")
+        self.database.execute(
+            """
+            INSERT INTO index_target_directories(fullpath, filename, size, mtime, priority, directory, generation, changed_generation) VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(fullpath) DO UPDATE SET
+                changed_generation=CASE
+                    WHEN (filename, size, mtime)=(excluded.filename, excluded.size, excluded.mtime)
+                    THEN index_target_directories.changed_generation
+                    ELSE excluded.changed_generation
+                END,
+                filename=excluded.filename, size=excluded.size, mtime=excluded.mtime,
+                priority=excluded.priority, directory=excluded.directory, generation=excluded.generation
+            WHERE index_target_directories.generation<excluded.generation
+            """,
+            (
+                file.fullpath,
+                file.get_filename(),
+                size,
+                file.get_mtime(),
+                priority,
+                directory,
+                generation,
+                generation,
+            ),
         )
+        return 1
+
+    def get_root(self, path: str, roots: list[str]) -> str:
+        # The deepest root containing the path
+        return max((r for r in roots if self.is_within(path, r)), key=len)
+
+    def is_within(self, path: str, directory: str) -> bool:
+        return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+    def create_staging_table(self) -> None:
+        # Files of the watch directories waiting for candidates, only visible to this connection
+        self.database.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS finder_staging (
+                fullpath VARCHAR PRIMARY KEY,
+                filename VARCHAR,
+                size LONG,
+                mtime LONG,
+                algorithm VARCHAR,
+                hash VARCHAR
+            );
+        """)
+
+    def get_candidates(
+        self,
+        files: list[File],
+        find_candidates_by: str,
+        hashes: dict[str, tuple[str, str]] = None,
+    ) -> Iterator[tuple[str, list[str]]]:
+        # Find the candidates of all the files at once with a single join,
+        # and yield them file by file, sorted by priority
+        # HASH needs the (algorithm, hash) of the files by fullpath, and only finds the files with that hash in the cache
+        hashes = hashes or {}
+        self.create_staging_table()
+        self.database.execute("DELETE FROM finder_staging;")
+        self.database.executemany(
+            "INSERT OR IGNORE INTO finder_staging(fullpath, filename, size, mtime, algorithm, hash) VALUES(?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    file.fullpath,
+                    file.get_filename(),
+                    file.get_size(),
+                    file.get_mtime(),
+                )
+                + hashes.get(file.fullpath, (None, None))
+                for file in files
+            ),
+        )
+
+        select = "SELECT s.fullpath, t.fullpath, t.priority FROM finder_staging s JOIN index_target_directories t"
+        if find_candidates_by == "SIZE":
+            query = f"{select} ON t.size=s.size"
+        elif find_candidates_by == "FILENAME":
+            query = f"{select} ON t.filename=s.filename"
+        elif find_candidates_by == "SIZE_OR_FILENAME":
+            # Each side of the union can use its own index, unlike an OR in the join
+            query = f"{select} ON t.size=s.size UNION {select} ON t.filename=s.filename"
+        elif find_candidates_by == "HASH":
+            # The hash must have been computed for the version of the file that is in the index
+            query = (
+                "SELECT s.fullpath, t.fullpath, t.priority FROM finder_staging s"
+                + " JOIN hashes h ON h.hash=s.hash AND h.algorithm=s.algorithm"
+                + " JOIN index_target_directories t ON t.fullpath=h.fullpath AND t.size=h.size AND t.mtime=h.mtime AND t.size=s.size"
+            )
+        else:
+            query = f"{select} ON t.size=s.size AND t.filename=s.filename"
+
+        self.metrics.increment("candidate_queries_total")
+        self.metrics.increment("candidate_lookups_total", len(files))
+
+        current_fullpath = None
+        candidates = []
+        for fullpath, candidate, priority in self.database.execute(
+            f"{query} ORDER BY 1, 3"
+        ):
+            if fullpath != current_fullpath:
+                if current_fullpath is not None:
+                    yield (current_fullpath, candidates)
+                current_fullpath = fullpath
+                candidates = []
+            candidates.append(candidate)
+
+        if current_fullpath is not None:
+            yield (current_fullpath, candidates)
 
-    def fetch_to_array(self, cursor: sqlite3.Cursor) -> list[str]:
-        return [c[0] for c in cursor.fetchall()]
+    def get_changed_generations(
+        self, column: str, values: list
+    ) -> dict[object, int]:
+        # Last generation in which a file with each of those sizes or filenames was added or changed
+        # Files that are not in the index are missing from the result
+        changed_generations = {}
+        values = list(set(values))
+        for i in range(0, len(values), 500):
+            chunk = values[i : i + 500]
+            for value, changed_generation in self.database.execute(
+                f"SELECT {column}, MAX(changed_generation) FROM index_target_directories WHERE {column} IN ({",".join("?" * len(chunk))}) GROUP BY {column}",
+                chunk,
+            ):
+                changed_generations[value] = changed_generation
+        return changed_generations
 
     def is_file_within_target_directories(self, fullpath: str) -> bool:
         # Actually, both directory and fullpath might not be absolute, and it's fine as long as it's consistent
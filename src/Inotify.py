@@ -0,0 +1,126 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+
+"""
+Minimal Linux inotify binding, using ctypes so there is no extra dependency.
+"""
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o0004000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    logger = logging.getLogger("Inotify")
+
+    mask: int = (
+        IN_CLOSE_WRITE
+        | IN_CREATE
+        | IN_MOVED_TO
+        | IN_MOVED_FROM
+        | IN_DELETE
+        | IN_DELETE_SELF
+        | IN_ONLYDIR
+        | IN_DONT_FOLLOW
+    )
+
+    def __init__(self):
+        library = ctypes.util.find_library("c")
+        if library is None:
+            raise OSError("Could not find the C library, inotify is not available")
+
+        self.libc = ctypes.CDLL(library, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("The C library doesn't support inotify")
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+
+        self.watches: dict[int, str] = {}
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        self.watches = {}
+
+    def add_watch(self, path: str) -> bool:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            self.logger.warning(
+                f"Could not watch {path}: {os.strerror(errno)} (you might need to raise fs.inotify.max_user_watches)"
+            )
+            return False
+
+        self.watches[wd] = path
+        return True
+
+    def add_watch_recursive(self, path: str, followlinks: bool = False) -> list[str]:
+        # Returns the files found while adding the watches, as they might have been created
+        # before the watch was in place
+        files = []
+        for root, dirs, filenames in os.walk(path, followlinks=followlinks):
+            self.add_watch(root)
+            files.extend(os.path.join(root, filename) for filename in filenames)
+        return files
+
+    def read_events(self, timeout: float) -> list[tuple[str | None, int]]:
+        # Returns (fullpath, mask) tuples; fullpath is None when the kernel queue overflowed
+        readable, _, _ = select.select([self.fd], [], [], max(0, timeout))
+        if len(readable) == 0:
+            return []
+
+        events = []
+        while True:
+            try:
+                buffer = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                name = buffer[offset : offset + length].rstrip(b"\0")
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    events.append((None, mask))
+                    continue
+
+                directory = self.watches.get(wd)
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                if directory is None:
+                    continue
+
+                if len(name) > 0:
+                    events.append((os.path.join(directory, os.fsdecode(name)), mask))
+                else:
+                    events.append((directory, mask))
+
+        return events
@@ -0,0 +1,129 @@
+import logging
+import os
+import threading
+import time
+
+"""
+Limit the reads from the symlink target directories, so hashing and copying don't saturate a remote mount
+(and stall whoever else is streaming from it). Token buckets limit the bytes/s and opens/s of each
+target directory, separately for hashing and for copying.
+"""
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount: float) -> float:
+        # Returns the seconds spent waiting
+        # The tokens can go negative, so concurrent callers queue up behind each other
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class IoLimiter:
+    # Limits and counts the I/O of one kind (hashing or copying) on one target directory
+
+    def __init__(self, name: str, bytes_per_second: float, opens_per_second: float):
+        self.name = name
+        self.bytes_bucket = (
+            TokenBucket(bytes_per_second, bytes_per_second)
+            if bytes_per_second > 0
+            else None
+        )
+        self.opens_bucket = (
+            TokenBucket(opens_per_second, opens_per_second)
+            if opens_per_second > 0
+            else None
+        )
+
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters(self) -> None:
+        with self.lock:
+            self.start_time = time.monotonic()
+            self.read_bytes = 0
+            self.opens = 0
+            self.waited_seconds = 0.0
+
+    def opened(self) -> None:
+        waited = self.opens_bucket.take(1) if self.opens_bucket is not None else 0
+        with self.lock:
+            self.opens += 1
+            self.waited_seconds += waited
+
+    def read(self, size: int) -> None:
+        waited = self.bytes_bucket.take(size) if self.bytes_bucket is not None else 0
+        with self.lock:
+            self.read_bytes += size
+            self.waited_seconds += waited
+
+    def describe(self) -> str:
+        elapsed = max(time.monotonic() - self.start_time, 0.001)
+        return (
+            f"{self.name}: read {round(self.read_bytes / 10**6)} MB ({self.read_bytes / 10**6 / elapsed:.1f} MB/s), "
+            + f"opened {self.opens} files ({self.opens / elapsed:.2f}/s), throttled for {self.waited_seconds:.1f} seconds"
+        )
+
+
+class IoScheduler:
+    logger = logging.getLogger("IoScheduler")
+
+    kinds: list[str] = ["hashing", "copying"]
+
+    def __init__(self, config: dict, target_directories: list[dict]):
+        self.config = config
+
+        # Deepest directories first, so they win over their parents
+        self.directories = sorted(
+            [d["dir"].rstrip(os.sep) for d in target_directories],
+            key=len,
+            reverse=True,
+        )
+
+        self.limiters: dict[tuple[str, str], IoLimiter] = {}
+        self.lock = threading.Lock()
+
+    def get_directory(self, fullpath: str) -> str | None:
+        for directory in self.directories:
+            if fullpath.startswith(directory + os.sep):
+                return directory
+        return None
+
+    def get_limiter(self, fullpath: str, kind: str) -> IoLimiter | None:
+        # None if the file is not in a target directory, in which case it's not limited
+        directory = self.get_directory(fullpath)
+        if directory is None:
+            return None
+
+        with self.lock:
+            if (kind, directory) not in self.limiters:
+                limits = self.config[kind]
+                self.limiters[(kind, directory)] = IoLimiter(
+                    f"{kind} from {directory}",
+                    limits["bytes-per-second"],
+                    limits["opens-per-second"],
+                )
+            return self.limiters[(kind, directory)]
+
+    def report(self) -> None:
+        with self.lock:
+            limiters = list(self.limiters.values())
+
+        for limiter in limiters:
+            if limiter.opens > 0:
+                self.logger.info(f"Effective rates for {limiter.describe()}")
+            limiter.reset_counters()
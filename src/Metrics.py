@@ -0,0 +1,105 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Iterator
+
+"""
+Counters and timings of a run, written as a Prometheus textfile (for the node_exporter textfile collector)
+and as JSON. Components get it injected, and a Metrics without files configured just isn't written.
+"""
+
+
+class Metrics:
+    logger = logging.getLogger("Metrics")
+
+    prefix: str = "symlinkerr_"
+
+    def __init__(self, config: dict = None):
+        self.config = config or {}
+        self.prometheus_file = self.config.get("prometheus-file") or ""
+        self.json_file = self.config.get("json-file") or ""
+
+        # Name => labels (sorted tuple of (key, value)) => value
+        self.values: dict[str, dict[tuple, float]] = {}
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self.lock:
+            values = self.values.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self.lock:
+            self.values.setdefault(name, {})[key] = value
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.increment(name, time.perf_counter() - start_time, **labels)
+
+    def write(self) -> None:
+        if self.prometheus_file:
+            self.write_atomically(self.prometheus_file, self.to_prometheus())
+        if self.json_file:
+            self.write_atomically(self.json_file, json.dumps(self.to_json(), indent=2))
+
+    def write_atomically(self, path: str, content: str) -> None:
+        # Readers (like node_exporter) must never see a partially written file
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary_path, "w") as f:
+                f.write(content)
+            os.replace(temporary_path, path)
+        except OSError as e:
+            self.logger.error(f"Could not write the metrics to {path}: {e}")
+
+    def get_snapshot(self) -> dict[str, dict[tuple, float]]:
+        with self.lock:
+            snapshot = {name: dict(values) for name, values in self.values.items()}
+        snapshot["run_start_timestamp_seconds"] = {(): self.start_time}
+        snapshot["run_duration_seconds"] = {(): time.time() - self.start_time}
+        return snapshot
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for name, values in sorted(self.get_snapshot().items()):
+            metric = self.prefix + name
+            lines.append(
+                f"# TYPE {metric} {'counter' if name.endswith('_total') else 'gauge'}"
+            )
+            for key, value in sorted(values.items()):
+                labels = ",".join(f'{k}="{self.escape(v)}"' for k, v in key)
+                lines.append(f"{metric}{{{labels}}} {value}" if labels else f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> dict:
+        return {
+            self.prefix + name: [
+                {"labels": dict(key), "value": value}
+                for key, value in sorted(values.items())
+            ]
+            for name, values in sorted(self.get_snapshot().items())
+        }
+
+    def escape(self, value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class ErrorCounter(logging.Handler):
+    # Counts everything logged as an error, by logger, so errors don't have to be counted everywhere
+
+    def __init__(self, metrics: Metrics):
+        super().__init__(logging.ERROR)
+        self.metrics = metrics
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.metrics.increment("errors_total", logger=record.name)
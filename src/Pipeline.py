@@ -0,0 +1,353 @@
+import logging
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Callable
+
+from src.Checker import Checker
+from src.File import File
+from src.VerdictCache import VerdictCache
+
+if TYPE_CHECKING:
+    from src.Finder import Finder
+
+"""
+Replace files with symlinks using stages connected by bounded queues, so a slow hash doesn't stop
+the directory traversal: walker -> eligibility filter -> candidate lookup -> hash verifiers -> replacer.
+The database is only used from the calling thread (candidate lookup, cache and replacer),
+the other stages only touch the filesystem.
+"""
+
+
+class PipelineStage:
+    __slots__ = ("name", "queue", "processed")
+
+    def __init__(self, name: str, maxsize: int = 0):
+        self.name = name
+        self.queue: queue.Queue = queue.Queue(maxsize)  # Waiting to be processed by this stage
+        self.processed = 0  # Only updated by the thread running the stage
+
+    def describe(self, elapsed: float) -> str:
+        return f"{self.name}: {self.processed} done ({self.processed / max(elapsed, 0.001):.1f}/s), {self.queue.qsize()} queued"
+
+
+class Verification:
+    # Check one file against its candidates in a verifier thread, without using the database:
+    # the cached values are loaded before, and the computed ones stored after, by the calling thread
+
+    def __init__(self, checker: Checker, file: File, candidates: list[File]):
+        self.checker = checker
+        self.file = file
+        self.candidates = candidates
+
+        self.cached: dict[str, dict[str, str]] = {"fingerprint": {}, "hash": {}}
+        self.computed: dict[str, dict[str, tuple[File, str]]] = {
+            "fingerprint": {},
+            "hash": {},
+        }
+        self.selected: File | None = None
+        self.errors: list[tuple[File, Exception]] = []
+
+    def load_cached(self) -> None:
+        if not self.checker.check_hash:
+            return
+
+        columns = ["hash"]
+        if self.checker.check_fingerprint:
+            columns.append("fingerprint")
+
+        for file in [self.file] + self.candidates:
+            for column in columns:
+                try:
+                    value = self.checker.get_cached(file, column)
+                except OSError:
+                    continue  # Will be raised again, and properly reported, when verifying
+                if value is not None:
+                    self.cached[column][file.fullpath] = value
+
+    def run(self) -> "Verification":
+        self.candidates = self.checker.order_candidates(
+            self.file, self.candidates, self.cached["hash"], self
+        )
+        for candidate in self.candidates:
+            try:
+                if self.checker.can_be_replaced_with(self.file, candidate, self):
+                    self.selected = candidate
+                    break  # Do not evaluate other candidates
+            except Exception as e:
+                self.errors.append((candidate, e))
+        return self
+
+    def store_computed(self) -> None:
+        for column, values in self.computed.items():
+            for file, value in values.values():
+                self.checker.store_in_cache(file, column, value)
+
+    def get_fingerprints(self, files: list[File]) -> dict[str, str]:
+        return self.get_values(files, "fingerprint", self.checker.compute_fingerprint)
+
+    def get_hashes(self, files: list[File]) -> dict[str, str]:
+        return self.get_values(files, "hash", self.checker.timed_compute_hash)
+
+    def get_values(
+        self, files: list[File], column: str, compute: Callable[[File], str]
+    ) -> dict[str, str]:
+        values = {}
+        futures = {}
+        for file in files:
+            if file.fullpath in values or file.fullpath in futures:
+                continue
+
+            if file.fullpath in self.cached[column]:
+                values[file.fullpath] = self.cached[column][file.fullpath]
+            elif file.fullpath in self.computed[column]:
+                values[file.fullpath] = self.computed[column][file.fullpath][1]
+            else:
+                futures[file.fullpath] = (
+                    file,
+                    self.checker.hash_executor.submit(file, compute),
+                )
+
+        error = None
+        for fullpath, (file, future) in futures.items():
+            try:
+                values[fullpath] = future.result()
+                self.computed[column][fullpath] = (file, values[fullpath])
+            except Exception as e:
+                error = error or e
+
+        if error is not None:
+            raise error
+        return values
+
+
+class Pipeline:
+    logger = logging.getLogger("Pipeline")
+
+    def __init__(self, config: dict, finder: "Finder"):
+        self.config = config
+        self.finder = finder
+        self.checker = finder.checker
+        self.replacer = finder.replacer
+
+        self.queue_size = max(1, config["queue-size"])
+        self.verifier_threads = max(1, config["verifier-threads"])
+        self.report_every_seconds = config["report-every-seconds"]
+
+    def run(
+        self,
+        paths: list[str],
+        reuse_listing: Callable[[str, int], list[str] | None] = None,
+        prune: Callable[[str], bool] = None,
+    ) -> None:
+        self.stopping = threading.Event()
+        self.walk_completed = False
+        self.walker = PipelineStage("walker", self.queue_size)
+        self.eligibility = PipelineStage("eligibility", self.queue_size)
+        self.lookup = PipelineStage("lookup")
+        self.verifier = PipelineStage("verifier", self.verifier_threads * 2)
+        self.replacement = PipelineStage("replacer")
+        self.stages = [
+            self.walker,
+            self.eligibility,
+            self.lookup,
+            self.verifier,
+            self.replacement,
+        ]
+        self.in_flight = 0  # Submitted to the verifiers and not replaced yet
+        self.start_time = time.time()
+        self.last_report = self.start_time
+
+        threads = [
+            threading.Thread(
+                target=self.walk,
+                args=(paths, reuse_listing, prune),
+                name="Pipeline-walker",
+            ),
+            threading.Thread(target=self.filter_eligible, name="Pipeline-eligibility"),
+        ] + [
+            threading.Thread(target=self.verify, name=f"Pipeline-verifier-{i}")
+            for i in range(self.verifier_threads)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            done = False
+            while not done or self.in_flight > 0:
+                self.replace_verified(timeout=None)
+
+                batch = []
+                if not done:
+                    batch, done = self.get_eligible_batch()
+                if len(batch) > 0:
+                    self.look_up(batch)
+                elif self.in_flight > 0:
+                    self.replace_verified(timeout=0.1)
+
+                self.finder.flush(force=False)
+                self.report(force=False)
+
+            self.finder.flush()
+            self.report(force=True)
+        finally:
+            self.stopping.set()
+            for _ in range(self.verifier_threads):
+                try:
+                    self.verifier.queue.put_nowait(None)
+                except queue.Full:
+                    pass  # The verifiers will see that we are stopping anyway
+
+    def put(self, stage: PipelineStage, item) -> bool:
+        # Blocks while the next stage is full (backpressure), unless we are stopping
+        while not self.stopping.is_set():
+            try:
+                stage.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def walk(
+        self,
+        paths: list[str],
+        reuse_listing: Callable[[str, int], list[str] | None],
+        prune: Callable[[str], bool],
+    ) -> None:
+        try:
+            for walked in self.finder.walker.walk(
+                paths, reuse_listing=reuse_listing, prune=prune
+            ):
+                if not self.put(self.walker, walked):
+                    return
+            self.walk_completed = True
+        except Exception as e:
+            self.logger.error(f"An exception occured while walking {paths}: {e}")
+        finally:
+            self.put(self.walker, None)
+
+    def filter_eligible(self) -> None:
+        try:
+            while True:
+                walked = self.walker.queue.get()
+                if walked is None:
+                    break
+                self.walker.processed += 1
+                self.eligibility.processed += len(walked.files)
+
+                for file in self.finder.get_eligible_files(walked):
+                    if not self.put(self.eligibility, file):
+                        return
+        except Exception as e:
+            self.logger.error(f"An exception occured while filtering files: {e}")
+        finally:
+            self.put(self.eligibility, None)
+
+    def verify(self) -> None:
+        while not self.stopping.is_set():
+            try:
+                verification = self.verifier.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if verification is None:
+                return
+
+            self.replacement.queue.put(verification.run())
+
+    def get_eligible_batch(self) -> tuple[list[File], bool]:
+        # Returns the files available right away (up to a batch), and whether the walk is over
+        # Only wait for new files if there is nothing else to do
+        batch = []
+        try:
+            file = self.eligibility.queue.get(timeout=0.1 if self.in_flight == 0 else 0)
+            while True:
+                if file is None:
+                    return batch, True
+                batch.append(file)
+                if len(batch) >= self.finder.candidates_batch_size:
+                    break
+                file = self.eligibility.queue.get_nowait()
+        except queue.Empty:
+            pass
+        return batch, False
+
+    def look_up(self, batch: list[File]) -> None:
+        self.lookup.processed += len(batch)
+        for file, candidates in self.finder.find_candidates(batch):
+            verification = Verification(self.checker, file, candidates)
+            verification.load_cached()
+
+            # Don't block on a full verifier queue, the verifiers might be waiting for us to replace files
+            while True:
+                try:
+                    self.verifier.queue.put_nowait(verification)
+                    break
+                except queue.Full:
+                    self.replace_verified(timeout=0.1)
+            self.in_flight += 1
+
+    def replace_verified(self, timeout: float | None) -> None:
+        # Replace all the verified files available, waiting up to timeout for the first one (None: don't wait)
+        while True:
+            try:
+                if timeout is None:
+                    verification = self.replacement.queue.get_nowait()
+                else:
+                    verification = self.replacement.queue.get(timeout=timeout)
+                    timeout = None
+            except queue.Empty:
+                return
+
+            self.in_flight -= 1
+            self.verifier.processed += 1
+            self.replace(verification)
+
+    def replace(self, verification: Verification) -> None:
+        verification.store_computed()
+
+        file = verification.file
+        for candidate_file, e in verification.errors:
+            self.logger.error(
+                f"An exception occured while replacing {file.fullpath} with a symlink to {candidate_file.fullpath}: {e}"
+            )
+
+        candidate_file = verification.selected
+        if candidate_file is None:
+            # Errors might not happen next time, so only remember actual mismatches
+            if len(verification.errors) == 0:
+                self.finder.verdicts.record(
+                    file, VerdictCache.ALL_MISMATCHED, self.finder.index_generation
+                )
+            self.finder.snapshots.file_done(
+                file, replaced=False, retry=len(verification.errors) > 0
+            )
+            return
+
+        self.logger.info(
+            f"Selected candidate {candidate_file.fullpath} which matched all criteria, performing replacement"
+        )
+        try:
+            with self.finder.profiler.span("replace", file=file.fullpath):
+                self.replacer.replace_with_symlink(file, candidate_file)
+            self.replacement.processed += 1
+            # A dry run doesn't replace anything, the file must be found again next time
+            self.finder.snapshots.file_done(
+                file, not self.replacer.dry_run, retry=self.replacer.dry_run
+            )
+        except Exception as e:
+            self.logger.error(
+                f"An exception occured while replacing {file.fullpath} with a symlink to {candidate_file.fullpath}: {e}"
+            )
+            self.finder.snapshots.file_done(file, replaced=False, retry=True)
+
+    def report(self, force: bool) -> None:
+        now = time.time()
+        if not force and now - self.last_report < self.report_every_seconds:
+            return
+
+        self.last_report = now
+        elapsed = now - self.start_time
+        self.logger.info(
+            f"Pipeline after {round(elapsed)} seconds, {self.in_flight} files being verified:\n{"\n".join(stage.describe(elapsed) for stage in self.stages)}"
+        )
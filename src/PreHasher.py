@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+from src.Checker import Checker
+from src.File import File
+from src.Indexer import Indexer
+
+"""
+Use the time spent sleeping between two runs to hash the candidates of the files that were too young
+to be replaced, so they are verified from the cache once they are old enough.
+Only the candidates are hashed: the young files themselves might still be written to.
+Everything is interrupted when the next run is due.
+"""
+
+
+class PreHasher:
+    logger = logging.getLogger("PreHasher")
+
+    def __init__(
+        self,
+        config: dict,
+        checker: Checker,
+        indexer: Indexer,
+        find_candidates_by: str,
+    ):
+        self.config = config
+        self.checker = checker
+        self.indexer = indexer
+        # The candidates of the same size are the ones that might need to be hashed for HASH
+        self.find_candidates_by = (
+            "SIZE" if find_candidates_by == "HASH" else find_candidates_by
+        )
+
+        self.enabled = self.config["enabled"]
+        self.max_candidates_per_file = self.config["max-candidates-per-file"]
+        self.stop_seconds_before_next_run = self.config[
+            "stop-seconds-before-next-run"
+        ]
+
+    def get_candidates(self, files: list[File]) -> list[tuple[File, list[str]]]:
+        # Returns the candidates with what is missing from the cache (hash and/or fingerprint)
+        # The best candidates of all the files first, then the second best ones, etc.
+        ranked = []
+        for _, candidates in self.indexer.get_candidates(
+            files, self.find_candidates_by
+        ):
+            for rank, candidate in enumerate(
+                candidates[: self.max_candidates_per_file]
+            ):
+                ranked.append((rank, len(ranked), candidate))
+
+        candidates = []
+        seen = set()
+        for _, _, fullpath in sorted(ranked):
+            if fullpath in seen:
+                continue
+            seen.add(fullpath)
+
+            candidate = File(fullpath)
+            if self.checker.is_excluded_target(candidate):
+                continue
+            columns = ["hash"]
+            if self.checker.check_fingerprint:
+                columns.insert(0, "fingerprint")
+            try:
+                columns = [
+                    column
+                    for column in columns
+                    if self.checker.get_cached(candidate, column) is None
+                ]
+            except OSError as e:
+                self.logger.debug(f"Could not stat {fullpath}: {e}")
+                continue
+            if len(columns) > 0:
+                candidates.append((candidate, columns))
+        return candidates
+
+    def compute(
+        self, file: File, columns: list[str], stop: threading.Event
+    ) -> dict[str, str]:
+        # Runs in the hash executor threads
+        values = {}
+        for column in columns:
+            if column == "fingerprint":
+                values[column] = self.checker.compute_fingerprint(file)
+            else:
+                values[column] = self.checker.get_provided_hash(
+                    file, stop
+                ) or self.checker.compute_hash(file, stop)
+        return values
+
+    def run(self, files: list[File], next_run: float) -> None:
+        # Returns at the latest stop-seconds-before-next-run before next_run
+        if not self.enabled or not self.checker.check_hash or len(files) == 0:
+            return
+
+        deadline = next_run - self.stop_seconds_before_next_run
+        candidates = self.get_candidates(files)
+        if len(candidates) == 0 or time.time() >= deadline:
+            return
+
+        self.logger.info(
+            f"Hashing {len(candidates)} candidates of {len(files)} files that are not old enough to be replaced yet, until the next run"
+        )
+
+        # The hash executor limits the concurrency per device, and the hashing limits of the IoScheduler apply
+        stop = threading.Event()
+        futures: dict[Future, File] = {
+            self.checker.hash_executor.submit(
+                candidate,
+                lambda file, columns=columns: self.compute(file, columns, stop),
+            ): candidate
+            for candidate, columns in candidates
+        }
+
+        hashed = 0
+        pending = set(futures)
+        try:
+            while len(pending) > 0:
+                done, pending = wait(
+                    pending,
+                    timeout=max(0, deadline - time.time()),
+                    return_when=FIRST_COMPLETED,
+                )
+                if len(done) == 0:
+                    break  # The next run is due
+
+                # The database must only be used from this thread
+                for future in done:
+                    candidate = futures[future]
+                    try:
+                        for column, value in future.result().items():
+                            self.checker.store_in_cache(candidate, column, value)
+                        hashed += 1
+                    except Exception as e:
+                        self.logger.debug(f"Could not hash {candidate.fullpath}: {e}")
+        finally:
+            stop.set()
+            for future in pending:
+                future.cancel()
+
+        self.checker.metrics.increment("pre_hashed_files_total", hashed)
+        self.logger.info(
+            f"Hashed {hashed} of the {len(candidates)} candidates, {len(pending)} left for later"
+        )
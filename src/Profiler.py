@@ -0,0 +1,98 @@
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+from typing import Iterator
+
+"""
+Profile each phase of a run with cProfile (one .pstats file per phase), and optionally record a span
+for each file processed (stat, lookup, hash, replace) as a Chrome trace, to open in chrome://tracing or Perfetto.
+A Profiler without directory does nothing, so the components can always use it.
+"""
+
+
+class Profiler:
+    logger = logging.getLogger("Profiler")
+
+    def __init__(self, directory: str = None, trace: bool = False):
+        self.directory = directory
+        self.trace = directory is not None and trace
+        self.prefix = time.strftime("%Y%m%d-%H%M%S")
+
+        self.events: list[dict] = []
+        self.thread_names: dict[int, str] = {}  # So the pools can be told apart
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        # cProfile only sees the calling thread, the work done in the thread pools shows up in the trace
+        if self.directory is None:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        with self.span(name, category="phase"):
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+
+        path = os.path.join(self.directory, f"{self.prefix}-{name}.pstats")
+        profile.dump_stats(path)
+        self.logger.info(f"Profile of the {name} phase written to {path}")
+
+    def span(self, name: str, category: str = "file", **args):
+        if not self.trace:
+            return contextlib.nullcontext()
+        return self.record_span(name, category, args)
+
+    @contextlib.contextmanager
+    def record_span(self, name: str, category: str, args: dict) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            end_time = time.perf_counter()
+            # Appending to a list is atomic, no need for a lock
+            thread = threading.current_thread()
+            self.thread_names[thread.ident] = thread.name
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": (start_time - self.origin) * 10**6,
+                    "dur": (end_time - start_time) * 10**6,
+                    "pid": self.pid,
+                    "tid": thread.ident,
+                    "args": args,
+                }
+            )
+
+    def write_trace(self) -> None:
+        if not self.trace:
+            return
+
+        metadata = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": self.pid,
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for tid, name in self.thread_names.items()
+        ]
+
+        path = os.path.join(self.directory, f"{self.prefix}-trace.json")
+        with open(path, "w") as f:
+            json.dump({"traceEvents": metadata + self.events}, f)
+        self.logger.info(f"Trace with {len(self.events)} spans written to {path}")
@@ -4,7 +4,12 @@ import shutil
 import sqlite3
 import time
 
+from src.Checker import Checker
+from src.Copier import Copier
 from src.File import File
+from src.HashTree import CorruptedChunkError, TreeHasher
+from src.IoScheduler import IoScheduler
+from src.Metrics import Metrics
 
 
 class Replacer:
@@ -14,11 +19,20 @@ class Replacer:
     dry_run_changes: list[str] = []
 
     def __init__(
-        self, config: dict, database: sqlite3.Connection, interactive: bool = False
+        self,
+        config: dict,
+        database: sqlite3.Connection,
+        interactive: bool = False,
+        checker: Checker = None,
+        io_scheduler: IoScheduler = None,
+        metrics: Metrics = None,
     ):
         self.config: dict = config
         self.database: sqlite3.Connection = database
         self.interactive: bool = interactive
+        self.checker: Checker = checker  # Used to verify the restored content
+        self.io_scheduler: IoScheduler = io_scheduler  # Used to throttle the copies
+        self.metrics: Metrics = metrics or Metrics()
 
         self.dry_run: bool = config["dry-run"]
         self.add_suffix: str = config["add-suffix-instead-of-deleting"]
@@ -28,6 +42,9 @@ class Replacer:
         self.chown_gid = config["chown-gid"]
         self.chmod = config["chmod"]
 
+        self.copier = Copier(config["copy-buffer-bytes"])
+        self.resume_partial_copies = config["resume-partial-copies"]
+
         self.create_changelog_table()
 
     def clear_changelog(self) -> None:
@@ -176,6 +193,55 @@ class Replacer:
         ):
             return
 
+        self.metrics.increment("replacements_total", action="symlink")
+        self.metrics.increment("replaced_bytes_total", file.get_size(), action="symlink")
+
+    def retarget_symlink(self, symlink_file: File, new_target: File) -> None:
+        old_target = symlink_file.get_readlink()
+        self.logger.info(
+            f"Retargeting {symlink_file.fullpath} from {old_target} to {new_target.fullpath}"
+        )
+        if self.dry_run:
+            self.logger.info(
+                "Just kidding, not actually doing anything, we are in a dry-run!"
+            )
+            self.log_dry_run_change(
+                f"Would have retargeted {symlink_file.fullpath} from {old_target} to {new_target.fullpath}"
+            )
+            return
+
+        # The new symlink is made in a temporary location, then renamed over the old one, so there is always a symlink there
+        temporary_file = File(symlink_file.fullpath + self.temporary_suffix)
+
+        def retarget_symlink():
+            self.log_change(
+                symlink_file.fullpath,
+                symlink_file.fullpath,
+                old_target,
+                "RETARGET_SYMLINK_START",
+            )
+            if os.path.lexists(temporary_file.fullpath):
+                self.logger.debug(f"Removing existing temporary file {temporary_file.fullpath}")
+                os.remove(temporary_file.fullpath)
+            self.logger.debug(f"Making symlink in temporary location {temporary_file.fullpath} ==> {new_target.fullpath}")
+            os.symlink(new_target.fullpath, temporary_file.fullpath)
+            self.chown(temporary_file)
+            os.replace(temporary_file.fullpath, symlink_file.fullpath)
+            self.log_change(
+                symlink_file.fullpath,
+                symlink_file.fullpath,
+                new_target.fullpath,
+                "RETARGET_SYMLINK_COMMIT",
+            )
+
+        if not self.wrap_interactive(
+            f"Retarget {symlink_file.fullpath} from {old_target} to {new_target.fullpath}?",
+            retarget_symlink,
+        ):
+            return
+
+        self.metrics.increment("replacements_total", action="retarget")
+
     def replace_with_content(self, symlink_file: File) -> None:
         self.logger.info(
             f"Replacing {symlink_file.fullpath} with its content from {symlink_file.get_readlink()}"
@@ -189,20 +255,56 @@ class Replacer:
             )
             return
 
+        # The hash is computed while copying, and compared to the one of the target we already know
+        target_file = File(
+            os.path.join(
+                os.path.dirname(symlink_file.fullpath), symlink_file.get_readlink()
+            )
+        )
+        # With a hash tree, each chunk is also compared as soon as it's copied
+        hasher = None
+        expected_hash = None
+        if self.checker is not None and self.checker.check_hash:
+            expected_hash = self.checker.get_cached(target_file, "hash")
+            hasher = self.checker.new_hasher(
+                target_file, self.checker.get_cached_chunks(target_file)
+            )
+
+        limiter = None
+        if self.io_scheduler is not None:
+            limiter = self.io_scheduler.get_limiter(target_file.fullpath, "copying")
+
         temporary_file = File(symlink_file.fullpath + self.temporary_suffix)
+        offset = 0
         if temporary_file.is_file():
+            # Resuming is only safe if we can check the whole content at the end
+            temporary_size = os.path.getsize(temporary_file.fullpath)
+            if (
+                self.resume_partial_copies
+                and expected_hash is not None
+                and temporary_size < target_file.get_size()
+            ):
+                self.logger.info(
+                    f"Resuming the copy to the existing temporary file {temporary_file.fullpath} after {temporary_size} bytes"
+                )
+                offset = temporary_size
+            else:
 
-            def remove_existing_tmp():
-                self.logger.debug(f"Removing existing temporary file {temporary_file.fullpath}")
-                temporary_file.remove()
+                def remove_existing_tmp():
+                    self.logger.debug(f"Removing existing temporary file {temporary_file.fullpath}")
+                    temporary_file.remove()
 
-            if not self.wrap_interactive(
-                f"Remove existing temporary file {temporary_file.fullpath}?",
-                remove_existing_tmp,
-            ):
-                return
+                if not self.wrap_interactive(
+                    f"Remove existing temporary file {temporary_file.fullpath}?",
+                    remove_existing_tmp,
+                ):
+                    return
+
+        copied_hash = None
+        corrupted_chunk: CorruptedChunkError = None
 
         def copy_content_to_tmp():
+            nonlocal copied_hash, corrupted_chunk
             self.log_change(
                 symlink_file.fullpath,
                 temporary_file.fullpath,
@@ -210,7 +312,18 @@ class Replacer:
                 "SYMLINK_COPY_CONTENT_START",
             )
             self.logger.debug(f"Copying content from {symlink_file.fullpath} to {temporary_file.fullpath}")
-            shutil.copy(symlink_file.fullpath, temporary_file.fullpath)
+            try:
+                copied_hash = self.copier.copy(
+                    symlink_file.fullpath,
+                    temporary_file.fullpath,
+                    hasher,
+                    offset,
+                    limiter,
+                )
+            except CorruptedChunkError as e:
+                corrupted_chunk = e
+                return
+            shutil.copymode(symlink_file.fullpath, temporary_file.fullpath)
             self.log_change(
                 symlink_file.fullpath,
                 temporary_file.fullpath,
@@ -226,8 +339,24 @@ class Replacer:
         ):
             return
 
-        # TODO: Shall we check the hashes are matching?
-        # At least, check that the size is correct
+        if corrupted_chunk is not None:
+            self.metrics.increment("copy_corrupted_chunks_total")
+            if self.resume_partial_copies and corrupted_chunk.offset > 0:
+                # The chunks before it are fine, the next attempt resumes from that one
+                self.logger.warn(
+                    f"Replacing {symlink_file.fullpath} content from {symlink_file.get_readlink()} failed: {corrupted_chunk}. "
+                    + f"Keeping the first {corrupted_chunk.offset} bytes of the temporary file, that were verified."
+                )
+                os.truncate(temporary_file.fullpath, corrupted_chunk.offset)
+            else:
+                self.logger.warn(
+                    f"Replacing {symlink_file.fullpath} content from {symlink_file.get_readlink()} failed: {corrupted_chunk}. "
+                    + "Removing the temporary file and not proceeding further with that file."
+                )
+                temporary_file.remove()
+            return
+
+        # Check that the size is correct
         if temporary_file.get_size() != symlink_file.get_size():
             self.logger.warn(
                 f"Replacing {symlink_file.fullpath} content from {symlink_file.get_readlink()} failed: sizes after copy are different. "
@@ -237,6 +366,22 @@ class Replacer:
             temporary_file.remove()
             return
 
+        # And the hash, when we know what it should be
+        if copied_hash is not None and expected_hash is not None:
+            if copied_hash != expected_hash:
+                self.logger.warn(
+                    f"Replacing {symlink_file.fullpath} content from {symlink_file.get_readlink()} failed: the hash of the copy is {copied_hash} but we were expecting {expected_hash}. "
+                    + "Removing the temporary file and not proceeding further with that file."
+                )
+                temporary_file.remove()
+                return
+            self.logger.info(f"The hash of the copy matches {expected_hash}")
+        elif copied_hash is not None:
+            # That's what we read from the target, so the next checks won't have to read it again
+            self.checker.store_in_cache(
+                target_file, "hash", copied_hash, chunks=self.get_chunks(hasher)
+            )
+
         def rename_tmp_to_final():
             self.log_change(
                 symlink_file.fullpath,
@@ -253,10 +398,26 @@ class Replacer:
                 "SYMLINK_CONTENT_RENAME_COMMIT",
             )
 
-        self.wrap_interactive(
+        if not self.wrap_interactive(
             f"Move the temporary file {temporary_file.fullpath} to {symlink_file.fullpath}?",
             rename_tmp_to_final,
+        ):
+            return
+
+        self.metrics.increment("replacements_total", action="content")
+        self.metrics.increment(
+            "replaced_bytes_total", temporary_file.get_size(), action="content"
         )
+        if copied_hash is not None:
+            self.checker.store_in_cache(
+                File(symlink_file.fullpath),
+                "hash",
+                copied_hash,
+                chunks=self.get_chunks(hasher),
+            )
+
+    def get_chunks(self, hasher) -> list[str] | None:
+        return hasher.chunks if isinstance(hasher, TreeHasher) else None
 
     def chown(self, file: File):
         try:
@@ -0,0 +1,190 @@
+import logging
+import os
+import sqlite3
+from typing import Iterator
+
+from src.Exclusions import Exclusions
+from src.File import File
+from src.Metrics import Metrics
+from src.Replacer import Replacer
+from src.Walker import Walker
+
+"""
+Point the symlinks to the new location of their target, eg. when the mount of the target directories moved,
+instead of replacing them with their content and back with symlinks, which would download and hash everything.
+The new target is found by moving the old one to a new prefix, or for dead symlinks, in the hashes cache by hash,
+or in the index by size and filename. The size and hash of the old target come from the cache, no file content is read.
+"""
+
+
+class Retargeter:
+    logger = logging.getLogger("Retargeter")
+
+    # What the changelog records when a symlink is made or moved
+    changelog_actions: tuple[str, ...] = ("MOVE_SYMLINK_COMMIT", "RETARGET_SYMLINK_COMMIT")
+
+    def __init__(
+        self,
+        config: dict,
+        database: sqlite3.Connection,
+        replacer: Replacer,
+        walker: Walker,
+        exclusions: Exclusions,
+        metrics: Metrics = None,
+    ):
+        self.config = config
+        self.database = database
+        self.replacer = replacer
+        self.walker = walker
+        self.exclusions = exclusions
+        self.metrics = metrics or Metrics()
+
+        self.moved_prefixes = [
+            (p["from"].rstrip(os.sep), p["to"].rstrip(os.sep))
+            for p in self.config["moved-prefixes"]
+        ]
+        self.dead_symlinks = self.config["dead-symlinks"]
+        self.from_changelog = self.config["from-changelog"]
+
+    def retarget_symlinks(self, paths: list[str]) -> None:
+        found = 0
+        retargeted = 0
+        for symlink_file, target in self.get_symlinks(paths):
+            if not self.needs_retarget(target):
+                continue
+            found += 1
+
+            new_target = self.get_new_target(symlink_file, target)
+            if new_target is None:
+                self.logger.warning(
+                    f"Could not find where {target}, the target of {symlink_file.fullpath}, went"
+                )
+                self.metrics.increment("symlinks_retargeted_total", method="none")
+                continue
+
+            new_target_path, method = new_target
+            try:
+                self.replacer.retarget_symlink(symlink_file, File(new_target_path))
+                self.metrics.increment("symlinks_retargeted_total", method=method)
+                retargeted += 1
+            except Exception as e:
+                self.logger.error(
+                    f"An exception occured while retargeting {symlink_file.fullpath} to {new_target_path}: {e}"
+                )
+
+        self.logger.info(
+            f"Retargeted {retargeted} of the {found} symlinks with a dead or moved target"
+        )
+
+    def get_symlinks(self, paths: list[str]) -> Iterator[tuple[File, str]]:
+        # Yields the symlinks with the absolute path of their target
+        if self.from_changelog:
+            # The last symlink made at each path, if it's still there
+            rows = self.database.execute(
+                f"""
+                SELECT fullpath FROM changelog WHERE id IN (
+                    SELECT MAX(id) FROM changelog WHERE action IN ({",".join("?" * len(self.changelog_actions))}) GROUP BY fullpath
+                ) ORDER BY fullpath
+                """,
+                self.changelog_actions,
+            ).fetchall()
+            files = (File(fullpath) for fullpath, in rows)
+        else:
+            files = (
+                File.from_dir_entry(entry)
+                for walked in self.walker.walk(
+                    paths, prune=self.exclusions.is_directory_excluded
+                )
+                for entry in walked.files
+            )
+
+        for symlink_file in files:
+            try:
+                if not symlink_file.is_link():
+                    continue
+                yield (
+                    symlink_file,
+                    os.path.join(
+                        os.path.dirname(symlink_file.fullpath),
+                        symlink_file.get_readlink(),
+                    ),
+                )
+            except OSError as e:
+                self.logger.error(f"Could not read the symlink {symlink_file.fullpath}: {e}")
+
+    def get_moved_target(self, target: str) -> str | None:
+        for old_prefix, new_prefix in self.moved_prefixes:
+            if target == old_prefix or target.startswith(old_prefix + os.sep):
+                return new_prefix + target[len(old_prefix) :]
+        return None
+
+    def needs_retarget(self, target: str) -> bool:
+        # Only a stat of the target, which is usually on a remote mount
+        if self.get_moved_target(target) is not None:
+            return True
+        return self.dead_symlinks and not os.path.exists(target)
+
+    def get_new_target(self, symlink_file: File, target: str) -> tuple[str, str] | None:
+        # Returns the new target and how it has been found
+        moved_target = self.get_moved_target(target)
+        if moved_target is not None and os.path.exists(moved_target):
+            return moved_target, "prefix"
+        if os.path.exists(target):
+            self.logger.warning(
+                f"{target}, the target of {symlink_file.fullpath}, is not at {moved_target}, keeping it"
+            )
+            return None
+
+        # The old target, or the file the symlink replaced, might have been hashed
+        rows = self.database.execute(
+            "SELECT size, algorithm, hash, fingerprint FROM hashes WHERE fullpath IN (?, ?) AND size IS NOT NULL ORDER BY fullpath=? DESC",
+            (target, symlink_file.fullpath, target),
+        ).fetchall()
+
+        # The same content, wherever it is now
+        for _, algorithm, file_hash, _ in rows:
+            if file_hash is None:
+                continue
+            # The hash must have been computed for the version of the file that is in the index
+            row = self.database.execute(
+                """
+                SELECT t.fullpath FROM hashes h
+                JOIN index_target_directories t ON t.fullpath=h.fullpath AND t.size=h.size AND t.mtime=h.mtime
+                WHERE h.hash=? AND h.algorithm=? AND t.fullpath<>?
+                ORDER BY t.priority LIMIT 1
+                """,
+                (file_hash, algorithm, target),
+            ).fetchone()
+            if row is not None:
+                return row[0], "hash"
+
+        # Otherwise a file with the same size and filename, unless its hash or fingerprint is known to be different
+        for size, algorithm, file_hash, fingerprint in rows:
+            row = self.database.execute(
+                """
+                SELECT t.fullpath FROM index_target_directories t
+                LEFT JOIN hashes h ON h.fullpath=t.fullpath AND h.algorithm=? AND h.size=t.size AND h.mtime=t.mtime
+                WHERE t.size=? AND t.filename=? AND t.fullpath<>?
+                    AND (h.hash IS NULL OR ? IS NULL OR h.hash=?)
+                    AND (h.fingerprint IS NULL OR ? IS NULL OR h.fingerprint=?
+                        OR substr(h.fingerprint, 1, instr(h.fingerprint, ':'))<>substr(?, 1, instr(?, ':')))
+                ORDER BY t.priority LIMIT 1
+                """,
+                (
+                    algorithm,
+                    size,
+                    os.path.basename(target),
+                    target,
+                    file_hash,
+                    file_hash,
+                    fingerprint,
+                    fingerprint,
+                    # Fingerprints taken with different sample sizes don't tell anything
+                    fingerprint,
+                    fingerprint,
+                ),
+            ).fetchone()
+            if row is not None:
+                return row[0], "size_and_filename"
+
+        return None
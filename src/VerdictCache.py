@@ -0,0 +1,155 @@
+import logging
+import sqlite3
+import time
+
+from src.File import File
+from src.Indexer import Indexer
+
+"""
+Remember the files for which no candidate was found, or whose candidates were all different,
+so they are not looked up (and their candidates hashed) again and again.
+A verdict stands as long as the file has the same size and mtime, and no file that could be a candidate
+(same size and/or filename, depending on find-candidates-by, same size for HASH) has been added to the index or changed since.
+"""
+
+
+class VerdictCache:
+    logger = logging.getLogger("VerdictCache")
+
+    NO_CANDIDATE: str = "no-candidate"
+    ALL_MISMATCHED: str = "all-mismatched"
+
+    def __init__(
+        self,
+        config: dict,
+        database: sqlite3.Connection,
+        indexer: Indexer,
+        settings: str,
+    ):
+        self.config = config
+        self.database = database
+        self.indexer = indexer
+        # Verdicts taken with other settings (candidates lookup, checks, exclusions) don't apply
+        self.settings = settings
+
+        self.enabled = self.config["enabled"]
+        self.max_age_seconds = self.config["max-age-seconds"]
+        self.pending: list[tuple] = []
+
+        self.create_verdicts_table()
+
+    def create_verdicts_table(self) -> None:
+        self.database.execute("""
+            CREATE TABLE IF NOT EXISTS finder_verdicts (
+                fullpath VARCHAR PRIMARY KEY,
+                size LONG,
+                mtime LONG,
+                verdict VARCHAR,
+                index_generation INT,
+                settings VARCHAR,
+                checked_at LONG
+            );
+        """)
+        self.database.commit()
+
+    def expire(self) -> None:
+        # Expired verdicts are checked again, this also forgets about the files that are gone
+        if self.max_age_seconds > 0:
+            self.database.execute(
+                "DELETE FROM finder_verdicts WHERE checked_at<?",
+                (round(time.time()) - self.max_age_seconds,),
+            )
+            self.database.commit()
+
+    def get_unchanged(self, files: list[File], find_candidates_by: str) -> set[str]:
+        # Returns the files that would get the same verdict as last time
+        if not self.enabled or len(files) == 0:
+            return set()
+
+        verdicts = {}
+        fullpaths = [file.fullpath for file in files]
+        for i in range(0, len(fullpaths), 500):
+            chunk = fullpaths[i : i + 500]
+            for fullpath, size, mtime, index_generation in self.database.execute(
+                f"SELECT fullpath, size, mtime, index_generation FROM finder_verdicts WHERE settings=? AND fullpath IN ({",".join("?" * len(chunk))})",
+                [self.settings] + chunk,
+            ):
+                verdicts[fullpath] = (size, mtime, index_generation)
+
+        files = [
+            file
+            for file in files
+            if verdicts.get(file.fullpath, (None, None))[:2]
+            == (file.get_size(), file.get_mtime())
+        ]
+        if len(files) == 0:
+            return set()
+
+        # Any candidate added or changed since the verdict invalidates it
+        by_size = {}
+        by_filename = {}
+        # HASH falls back to the files of the same size
+        if find_candidates_by == "HASH":
+            find_candidates_by = "SIZE"
+
+        if find_candidates_by != "FILENAME":
+            by_size = self.indexer.get_changed_generations(
+                "size", [file.get_size() for file in files]
+            )
+        if find_candidates_by != "SIZE":
+            by_filename = self.indexer.get_changed_generations(
+                "filename", [file.get_filename() for file in files]
+            )
+
+        unchanged = set()
+        for file in files:
+            index_generation = verdicts[file.fullpath][2]
+            size_unchanged = by_size.get(file.get_size(), 0) <= index_generation
+            filename_unchanged = (
+                by_filename.get(file.get_filename(), 0) <= index_generation
+            )
+
+            if find_candidates_by == "SIZE":
+                is_unchanged = size_unchanged
+            elif find_candidates_by == "FILENAME":
+                is_unchanged = filename_unchanged
+            elif find_candidates_by == "SIZE_OR_FILENAME":
+                is_unchanged = size_unchanged and filename_unchanged
+            else:
+                # A new candidate would have changed both
+                is_unchanged = size_unchanged or filename_unchanged
+
+            if is_unchanged:
+                unchanged.add(file.fullpath)
+        return unchanged
+
+    def record(self, file: File, verdict: str, index_generation: int) -> None:
+        if not self.enabled:
+            return
+
+        try:
+            self.pending.append(
+                (
+                    file.fullpath,
+                    file.get_size(),
+                    file.get_mtime(),
+                    verdict,
+                    index_generation,
+                    self.settings,
+                    round(time.time()),
+                )
+            )
+        except OSError:
+            pass  # It will be looked up again next time
+
+    def flush(self) -> None:
+        # Only called from the main thread, like everything using the database
+        if len(self.pending) == 0:
+            return
+
+        pending, self.pending = self.pending, []
+        self.database.executemany(
+            "INSERT OR REPLACE INTO finder_verdicts(fullpath, size, mtime, verdict, index_generation, settings, checked_at) VALUES(?, ?, ?, ?, ?, ?, ?)",
+            pending,
+        )
+        self.database.commit()
@@ -0,0 +1,171 @@
+import collections
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator
+
+"""
+Walk directory trees using a pool of threads, as each readdir/stat can be a network round trip on remote mounts.
+Directories are yielded as soon as they have been listed, so the caller can start working before the walk is over.
+"""
+
+
+class WalkedDirectory:
+    __slots__ = ("root", "path", "parent", "mtime", "files", "subdirectories", "listed")
+
+    def __init__(
+        self,
+        root: str,
+        path: str,
+        parent: str | None,
+        mtime: int,
+        files: list[os.DirEntry],
+        subdirectories: list[str],
+        listed: bool,
+    ):
+        self.root = root
+        self.path = path
+        self.parent = parent
+        self.mtime = mtime  # In nanoseconds, as returned by stat() before listing the directory
+        self.files = files  # Everything that is not a directory, symlinks to files included
+        self.subdirectories = subdirectories  # Directories that will be walked
+        self.listed = listed  # False if the listing has been skipped thanks to reuse_listing
+
+
+class Walker:
+    logger = logging.getLogger("Walker")
+
+    def __init__(
+        self,
+        threads: int = 8,
+        threads_per_root: int = 4,
+        followlinks: bool = False,
+        max_queued_directories: int = 1000,
+    ):
+        self.threads = max(1, threads)
+        self.threads_per_root = max(1, threads_per_root)
+        self.followlinks = followlinks
+        self.max_queued_directories = max_queued_directories
+
+    def walk(
+        self,
+        roots: list[str],
+        reuse_listing: Callable[[str, int], list[str] | None] = None,
+        prune: Callable[[str], bool] = None,
+        on_error: Callable[[str, str | None], None] = None,
+    ) -> Iterator[WalkedDirectory]:
+        # reuse_listing(path, mtime) can return the known subdirectories of a directory that didn't change,
+        # in which case it won't be listed (return None to list it)
+        # prune(path) returning True prevents a directory from being walked, roots included
+        # on_error(path, parent) is called when a directory couldn't be listed, so it's not yielded (nor its subdirectories)
+        # They are all called from the walker threads
+        if prune is not None:
+            roots = [root for root in roots if not prune(root)]
+        if len(roots) == 0:
+            return
+
+        results: queue.Queue = queue.Queue()
+        lock = threading.Lock()
+        pending = [collections.deque([(root, None)]) for root in roots]
+        running = [0] * len(roots)
+        state = {"outstanding": len(roots), "cancelled": False}
+        executor = ThreadPoolExecutor(
+            max_workers=self.threads, thread_name_prefix="Walker"
+        )
+
+        def dispatch() -> None:
+            # Must be called with the lock held
+            for i in range(len(roots)):
+                while (
+                    not state["cancelled"]
+                    and running[i] < self.threads_per_root
+                    and len(pending[i]) > 0
+                    and results.qsize() < self.max_queued_directories
+                ):
+                    path, parent = pending[i].popleft()
+                    running[i] += 1
+                    executor.submit(run, i, path, parent)
+
+        def run(i: int, path: str, parent: str | None) -> None:
+            walked = None
+            try:
+                walked = self.list_directory(
+                    roots[i], path, parent, reuse_listing, prune
+                )
+            except Exception as e:
+                self.logger.error(f"Could not list directory {path}: {e}")
+                if on_error is not None:
+                    on_error(path, parent)
+
+            with lock:
+                running[i] -= 1
+                state["outstanding"] -= 1
+                if walked is not None:
+                    for subdirectory in walked.subdirectories:
+                        pending[i].append((subdirectory, path))
+                    state["outstanding"] += len(walked.subdirectories)
+                    results.put(walked)
+                if state["outstanding"] == 0:
+                    results.put(None)
+                else:
+                    dispatch()
+
+        try:
+            with lock:
+                dispatch()
+
+            while True:
+                walked = results.get()
+                if walked is None:
+                    break
+
+                # Listing is throttled when too many directories are waiting to be consumed
+                with lock:
+                    dispatch()
+
+                yield walked
+        finally:
+            with lock:
+                state["cancelled"] = True
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def list_directory(
+        self,
+        root: str,
+        path: str,
+        parent: str | None,
+        reuse_listing: Callable[[str, int], list[str] | None],
+        prune: Callable[[str], bool],
+    ) -> WalkedDirectory:
+        # Stat before listing, so changes happening while we list are caught next time
+        mtime = os.stat(path).st_mtime_ns
+
+        if reuse_listing is not None:
+            subdirectories = reuse_listing(path, mtime)
+            if subdirectories is not None:
+                if prune is not None:
+                    subdirectories = [s for s in subdirectories if not prune(s)]
+                return WalkedDirectory(
+                    root, path, parent, mtime, [], subdirectories, False
+                )
+
+        files = []
+        subdirectories = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if self.followlinks or not entry.is_symlink():
+                            if prune is None or not prune(entry.path):
+                                subdirectories.append(entry.path)
+                        continue
+
+                    # Cache the stat on the DirEntry while we are in a walker thread
+                    entry.stat(follow_symlinks=False)
+                except OSError as e:
+                    self.logger.error(f"Could not stat {entry.path}: {e}")
+                files.append(entry)
+
+        return WalkedDirectory(root, path, parent, mtime, files, subdirectories, True)
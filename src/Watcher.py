@@ -0,0 +1,164 @@
+import logging
+import os
+import time
+
+from src.File import File
+from src.Finder import Finder
+from src.Inotify import (
+    IN_CREATE,
+    IN_DELETE,
+    IN_ISDIR,
+    IN_MOVED_FROM,
+    IN_MOVED_TO,
+    Inotify,
+)
+
+"""
+Keep track of the files changed in the watched directories using inotify, and process them
+through the Finder as soon as they are old enough, instead of waiting for the next full scan.
+"""
+
+
+class Watcher:
+    logger = logging.getLogger("Watcher")
+
+    def __init__(self, config: dict, min_age: int):
+        self.config = config
+        self.min_age = min_age
+        self.min_seconds_between_indexing = config["min-seconds-between-indexing"]
+
+        self.inotify: Inotify = None
+        self.watch_directories: list[str] = []
+        self.undo_directories: list[str] = []
+        self.followlinks: bool = False
+
+        # Path => time of the last event seen for it
+        self.dirty: dict[str, float] = {}
+        self.needs_full_rescan: bool = False
+        self.last_indexing: float = 0
+
+    def set_directories(
+        self,
+        watch_directories: list[str],
+        undo_directories: list[str],
+        followlinks: bool = False,
+    ) -> None:
+        if (
+            self.inotify is not None
+            and watch_directories == self.watch_directories
+            and undo_directories == self.undo_directories
+            and followlinks == self.followlinks
+        ):
+            return
+
+        if self.inotify is not None:
+            self.inotify.close()
+
+        self.watch_directories = watch_directories
+        self.undo_directories = undo_directories
+        self.followlinks = followlinks
+        self.dirty = {}
+
+        # This raises if inotify isn't available, and the caller will fallback to sleeping
+        self.inotify = Inotify()
+        for directory in watch_directories + undo_directories:
+            self.logger.info(f"Adding inotify watches on {directory}")
+            self.inotify.add_watch_recursive(directory, followlinks)
+
+    def indexed(self) -> None:
+        self.last_indexing = time.time()
+
+    def process_events(self, finder: Finder, deadline: float) -> None:
+        # Returns when the deadline is reached, or when a full rescan is needed
+        self.needs_full_rescan = False
+        self.logger.info(
+            f"Watching for changes until {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(deadline))}"
+        )
+
+        while not self.needs_full_rescan:
+            now = time.time()
+            if now >= deadline:
+                break
+
+            timeout = deadline - now
+            if len(self.dirty) > 0:
+                next_ready = min(self.dirty.values()) + self.min_age
+                timeout = min(timeout, max(0, next_ready - now))
+
+            self.poll(timeout)
+
+            now = time.time()
+            ready = [
+                path
+                for path, last_event in self.dirty.items()
+                if now - last_event >= self.min_age
+            ]
+            if len(ready) > 0:
+                self.process(finder, ready)
+
+        if self.needs_full_rescan:
+            self.logger.warning(
+                "Some inotify events have been lost, performing a full rescan"
+            )
+
+    def poll(self, timeout: float) -> None:
+        for path, mask in self.inotify.read_events(timeout):
+            if path is None:
+                self.needs_full_rescan = True
+                continue
+
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                self.dirty.pop(path, None)
+                continue
+
+            now = time.time()
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files might have been created before the watch was added
+                    for file in self.inotify.add_watch_recursive(path, self.followlinks):
+                        self.dirty[file] = now
+                continue
+
+            self.logger.debug(f"Change detected on {path}")
+            self.dirty[path] = now
+
+    def process(self, finder: Finder, paths: list[str]) -> None:
+        # Candidates might have appeared in the target directories since the last indexing
+        if time.time() - self.last_indexing >= self.min_seconds_between_indexing:
+            finder.indexer.index_target_directories()
+            self.indexed()
+
+        for path in paths:
+            del self.dirty[path]
+            try:
+                self.process_path(finder, path)
+            except Exception as e:
+                self.logger.error(f"An exception occured while processing {path}: {e}")
+
+        # The verdicts of these files would otherwise only be written by the next full scan
+        finder.flush()
+        finder.replacer.print_and_delete_dry_run_change()
+
+    def process_path(self, finder: Finder, path: str) -> None:
+        if not os.path.lexists(path):
+            return
+
+        file = File(path)
+        if file.is_link():
+            if self.is_within(path, self.undo_directories):
+                finder.find_and_replace_symlink_with_content(file)
+            return
+
+        if self.is_within(path, self.watch_directories) and file.is_file():
+            # The modification time can be more recent than the last event we saw, wait for it too
+            if time.time() - file.get_mtime() < self.min_age:
+                self.dirty[path] = file.get_mtime()
+                return
+
+            finder.find_and_replace_with_symlink(file)
+
+    def is_within(self, path: str, directories: list[str]) -> bool:
+        return any(
+            path.startswith(directory.rstrip(os.sep) + os.sep)
+            for directory in directories
+        )
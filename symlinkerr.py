@@ -4,17 +4,9 @@
 import argparse
 import logging
 import os
-import pprint
-import shutil
-import sqlite3
 import time
 
-import yaml
-
-from src.Checker import Checker
-from src.Finder import Finder
-from src.Indexer import Indexer
-from src.Replacer import Replacer
+from src.Engine import Engine
 
 IS_IN_DOCKER = os.environ.get("IS_IN_DOCKER")
 CONFIG_FILE = os.environ.get("CONFIG_FILE")
@@ -23,18 +15,6 @@ LOG_LEVEL = os.environ.get("LOG_LEVEL")
 INTERVAL_SECONDS = os.environ.get("INTERVAL")
 DRY_RUN = os.environ.get("DRY_RUN")
 
-def merge(source, destination):
-    if source is not None:
-        for key, value in source.items():
-            if isinstance(value, dict):
-                node = destination.setdefault(key, {})
-                merge(value, node)
-            else:
-                destination[key] = value
-
-    return destination
-
-
 def main():
     parser = argparse.ArgumentParser(
         description="""Replace files in a directory with symlinks to another one.
@@ -63,6 +43,26 @@ WARNING: THIS THING IS DESTRUCTIVE! It will delete stuff and replace them with s
         action="store_true",
         help="Confirm all replacements before performing them",
     )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="profile",
+        default=None,
+        type=str,
+        metavar="DIRECTORY",
+        help="Profile the index, find and undo phases, writing a .pstats file per phase in that directory (default: %(const)s)",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="With --profile, also write a Chrome trace with a span for each file processed (stat, lookup, hash, replace)",
+    )
+    parser.add_argument(
+        "--hashes-file",
+        default="hashes.jsonl.gz",
+        type=str,
+        help="File written by export-hashes and read by import-hashes (default: %(default)s)",
+    )
     parser.add_argument(
         "action",
         default="watch",
@@ -72,9 +72,13 @@ WARNING: THIS THING IS DESTRUCTIVE! It will delete stuff and replace them with s
             "replace-with-symlinks",
             "replace-with-content",
             "watch",
+            "retarget-symlinks",
             # "changelog",
             "clear-changelog",
             "clear-hashes",
+            "export-hashes",
+            "import-hashes",
+            "benchmark-hashes",
         ],
         help="Action to perform (default: %(default)s)",
     )
@@ -94,92 +98,37 @@ WARNING: THIS THING IS DESTRUCTIVE! It will delete stuff and replace them with s
 
     logger.info(f"Running with parameters: {vars(args)}")
 
-    config_default_file = "config_default.yml"
-    config_arg_file = args.config
-    with open(config_default_file, "r") as config_file:
-        config = yaml.safe_load(config_file)
-
-    while True:
-        start_time = round(time.time())
-
-        # Always reload the config when we loop, in case it changed on disk
-        # Create configuration file if it doesn't exist
-        if os.path.isfile(config_arg_file):
-            with open(config_arg_file, "r") as config_file:
-                config = merge(yaml.safe_load(config_file), config)
-        else:
-            logger.warn(
-                f"Configuration not found, creating a base one at {config_arg_file}"
-            )
-            shutil.copy("config_override_base.yml", config_arg_file)
-
-        logger.info(f"Configuration: {pprint.pformat(config)}")
-        logging.getLogger().setLevel(LOG_LEVEL or config["logger"]["level"])
-
-        with sqlite3.connect(DATABASE_FILE or config["database"]) as database:
-            indexer = Indexer(
-                config=config["indexer"],
-                target_directories=config["finder"]["directories"][
-                    "symlink-target-directories"
-                ],
-                database=database,
-                min_size=config["checker"]["files-min-size-bytes"],
-            )
-            checker = Checker(
-                config=config["checker"],
-                database=database,
-            )
-            replacer = Replacer(
-                config=config["replacer"],
-                database=database,
-                interactive=args.interactive,
-            )
-            finder = Finder(
-                config=config["finder"],
-                database=database,
-                indexer=indexer,
-                checker=checker,
-                replacer=replacer,
-            )
-
-            if DRY_RUN is not None:
-                # Anything but exactly "false" will be interpreted as a dry run
-                replacer.dry_run = not (DRY_RUN.lower() == "false")
-
-            if args.action in [
-                "watch",
-                "replace-with-symlinks",
-                "replace-with-content",
-            ]:
-                indexer.index_target_directories()
-
-            if args.action in ["watch", "replace-with-symlinks"]:
-                finder.find_and_replace_with_symlinks()
-
-            if args.action in ["watch", "replace-with-content"]:
-                finder.find_and_replace_with_content()
-
-            if args.action in ["clear-changelog"]:
-                replacer.clear_changelog()
-
-            if args.action in ["clear-hashes"]:
-                checker.clear_hashes_cache()
-
-            replacer.print_and_delete_dry_run_change()
-
-        # Release the sqlite connection while we sleep
-        if args.action in ["watch"]:
-            # Sleep so that the total time is interval-seconds
-            interval_duration = INTERVAL_SECONDS or config["watcher"]["interval-seconds"]
-            run_duration = round(time.time()) - start_time
-            sleep_duration = interval_duration - run_duration
-            if sleep_duration <= 0:
-                sleep_duration = interval_duration
-
-            logger.info(f"Sleeping for {sleep_duration} seconds...")
-            time.sleep(sleep_duration)
-        else:
-            return 0
+    engine = Engine(
+        args,
+        config_default_file="config_default.yml",
+        config_arg_file=args.config,
+        database_file=DATABASE_FILE,
+        log_level=LOG_LEVEL,
+        dry_run=DRY_RUN,
+    )
+    try:
+        while True:
+            start_time = round(time.time())
+
+            # The config is checked for changes on each run, the components only rebuilt if needed
+            engine.run(start_time)
+
+            if args.action in ["watch"] and engine.watcher is None:
+                # Sleep so that the total time is interval-seconds
+                interval_duration = int(
+                    INTERVAL_SECONDS or engine.config["watcher"]["interval-seconds"]
+                )
+                run_duration = round(time.time()) - start_time
+                sleep_duration = interval_duration - run_duration
+                if sleep_duration <= 0:
+                    sleep_duration = interval_duration
+
+                logger.info(f"Sleeping for {sleep_duration} seconds...")
+                engine.idle(time.time() + sleep_duration)
+            elif args.action not in ["watch"]:
+                return 0
+    finally:
+        engine.close()
 
 
 if __name__ == "__main__":